@@ -1,48 +1,178 @@
 import os
+import time
+import asyncio
+import hashlib
+import logging
 
-# Disable ChromaDB telemetry
-os.environ['ANONYMIZED_TELEMETRY'] = 'False'
-
-import chromadb
+import numpy as np
 from datetime import datetime
-from utils import url2text
-from late_chunking import process_large_text
-import fitz  # PyMuPDF for PDF handling
+from utils import fetch_url, fetch_urls
+from late_chunking import embed_windows, split_text_windows, split_page_stream, EMBED_MODEL_ID
+from embedding_cache import window_key
+from collection_registry import collection_registry, collection_versions
+from bm25 import bm25_indexes
+from pdf_extract import iter_pdf_pages
 
-chroma_client = chromadb.HttpClient(host='localhost', port=8027)
+logger = logging.getLogger(__name__)
 
 
 def extract_text_from_pdf(pdf_path: str) -> str:
     """Extract text from a PDF file."""
-    text = ""
-    with fitz.open(pdf_path) as pdf_document:
-        for page in pdf_document:
-            text += page.get_text()
-    return text
-
-
-def add_into_collection(data: str, collection_name: str):
-    collection = chroma_client.get_or_create_collection(name=collection_name)
+    return "".join(text for _, text in iter_pdf_pages(pdf_path))
+
+
+def chunk_id(source: str, window: int, chunk: int, text: str) -> str:
+    """Детерминированный id чанка: одинаковый вход всегда даёт тот же id, поэтому повторная индексация идемпотентна"""
+    source_hash = hashlib.sha256(source.encode('utf-8')).hexdigest()[:16]
+    text_hash = hashlib.sha256(text.encode('utf-8')).hexdigest()[:16]
+    return f"{source_hash}-{window}-{chunk}-{text_hash}"
+
+
+def source_chunk_records(source: str, chunks: list, metadatas: list, windows: list):
+    """
+    Returns:
+        tuple: (id чанков, метаданные чанков с source, номером окна и хэшем окна)
+    """
+    ids = []
+    window_chunks = {}
+    chunk_index = 0
+    for i, (text, window) in enumerate(zip(chunks, windows)):
+        if i and windows[i - 1] != window:
+            chunk_index = 0
+        ids.append(chunk_id(source, window, chunk_index, text))
+        window_chunks.setdefault(window, []).append(text)
+        chunk_index += 1
+    # По хэшу окна повторная индексация понимает, какие окна не изменились
+    window_hashes = {window: window_key(EMBED_MODEL_ID, texts) for window, texts in window_chunks.items()}
+    metadatas = [
+        {**metadata, 'source': source, 'window': window, 'window_hash': window_hashes[window]}
+        for metadata, window in zip(metadatas, windows)
+    ]
+    return ids, metadatas
+
+
+def stored_window_hashes(collection, source: str) -> dict:
+    """Хэши окон источника, уже лежащих в коллекции: {номер окна: хэш}"""
+    stored = collection.get(where={"source": source}, include=["metadatas"])
+    return {metadata['window']: metadata.get('window_hash') for metadata in stored['metadatas']}
+
+
+def delete_stale_chunks(collection, source: str, ids: list):
+    """
+    Удаляет чанки источника, которых нет среди ids (остались от прошлой версии)
+
+    Returns:
+        list: id удалённых чанков
+    """
+    stale = list(set(collection.get(where={"source": source}, include=[])['ids']) - set(ids))
+    if stale:
+        collection.delete(ids=stale)
+    return stale
+
+
+def add_into_collection(data: str, collection_name: str, on_stage=None, fetched=None):
+    """
+    Индексирует источник инкрементально: окна, хэш которых совпадает с уже сохранённым
+    под тем же номером, не пересчитываются. Чанки исчезнувших окон удаляются.
+
+    Args:
+        data (str): URL или путь к PDF
+        collection_name (str): Коллекция векторного хранилища
+        on_stage (callable, optional): Вызывается как on_stage(stage, seconds) после каждого этапа:
+            fetch (загрузка URL), extract (HTML / PDF -> окна), embed, insert. Страницы PDF читаются
+            потоком вперемешку с эмбеддингами, время чтения копится отдельно и из embed вычитается
+        fetched (FetchResult, optional): Уже загруженная страница для URL
+
+    Returns:
+        int: Сколько чанков пересчитано и записано. 0, если источник не изменился
+    """
+    def report(stage, seconds):
+        if on_stage is not None:
+            on_stage(stage, seconds)
+
+    collection = collection_registry.get(collection_name)
 
     metadata = {"created_at": datetime.now().isoformat()}
 
+    extract_seconds = 0.0
     if data.startswith("http"):
-        text = url2text(data)
+        started = time.monotonic()
+        if fetched is None:
+            fetched = fetch_url(data)
+        if fetched.error:
+            raise ValueError(f"Не удалось загрузить {data}: {fetched.error}")
+        report("fetch", time.monotonic() - started)
+        if not fetched.changed and collection.get(where={"url": data}, limit=1)['ids']:
+            # Страница не менялась и уже проиндексирована
+            return 0
         metadata['url'] = data
+        started = time.monotonic()
+        window_batches = [[(text_chunks, None) for text_chunks in split_text_windows(fetched.text)]]
+        report("extract", time.monotonic() - started)
     elif data.endswith(".pdf"):
-        text = extract_text_from_pdf(data)
         metadata['pdf_path'] = data
+        # Страницы PDF читаются и режутся на окна потоком
+        window_batches = split_page_stream(iter_pdf_pages(data))
     else:
         # костыль
         assert False, "Не поддерживаемый формат"
 
-    start = collection.count()
-    all_chunks, all_embeddings = process_large_text(text)
-
-    collection.add(
-        documents=all_chunks, embeddings=all_embeddings, metadatas=[metadata for _ in all_chunks],
-        ids=[str(i) for i in range(start, start + len(all_chunks))]
+    def timed_batches():
+        nonlocal extract_seconds
+        iterator = iter(window_batches)
+        while True:
+            batch_started = time.monotonic()
+            batch = next(iterator, None)
+            extract_seconds += time.monotonic() - batch_started
+            if batch is None:
+                return
+            yield batch
+
+    started = time.monotonic()
+    stored_hashes = stored_window_hashes(collection, data)
+    all_ids = []
+    chunks, embeddings, metadatas, windows = [], [], [], []
+    window_index = 0
+    reused = 0
+    for batch in timed_batches():
+        changed = []
+        for text_chunks, chunk_pages in batch:
+            all_ids.extend(chunk_id(data, window_index, i, text) for i, text in enumerate(text_chunks))
+            if stored_hashes.get(window_index) == window_key(EMBED_MODEL_ID, text_chunks):
+                reused += 1
+            else:
+                changed.append((window_index, text_chunks, chunk_pages))
+            window_index += 1
+
+        for (index, text_chunks, chunk_pages), window_embeddings in zip(
+                changed, embed_windows([text_chunks for _, text_chunks, _ in changed])
+        ):
+            chunks.extend(text_chunks)
+            embeddings.append(window_embeddings)
+            windows.extend([index] * len(text_chunks))
+            if chunk_pages is None:
+                metadatas.extend([metadata] * len(text_chunks))
+            else:
+                metadatas.extend({**metadata, 'page': page} for page in chunk_pages)
+    if data.endswith(".pdf"):
+        report("extract", extract_seconds)
+    report("embed", time.monotonic() - started - extract_seconds)
+
+    started = time.monotonic()
+    ids = []
+    if chunks:
+        ids, metadatas = source_chunk_records(data, chunks, metadatas, windows)
+        collection.upsert(documents=chunks, embeddings=np.concatenate(embeddings), metadatas=metadatas, ids=ids)
+    removed = delete_stale_chunks(collection, data, all_ids)
+    if ids or removed:
+        bm25_indexes.update(collection_name, collection, ids, chunks, metadatas, removed=removed)
+        collection_versions.bump(collection_name)
+    report("insert", time.monotonic() - started)
+    logger.info(
+        f"Indexed {data}: {window_index - reused} windows re-embedded, {reused} unchanged, "
+        f"{len(removed)} stale chunks removed"
     )
+    return len(chunks)
 
 
 if __name__ == '__main__':
@@ -66,10 +196,13 @@ https://ru.wikipedia.org/wiki/Красная_карточка
 https://translated.turbopages.org/proxy_u/en-ru.ru.eeb2ca27-6748226d-48e44fb5-74722d776562/https/www.geeksforgeeks.org/what-is-red-card-in-football/
 """
     urls = [i for i in urls.split("\n") if len(i)]
-    collection = chroma_client.get_or_create_collection("test")
+    collection = collection_registry.get("test")
     print("start with ", collection.count())
-    for i in urls:
-        add_into_collection(i, "test")
+    for result in asyncio.run(fetch_urls(urls)):
+        if result.error:
+            print("skip ", result.url, result.error)
+            continue
+        add_into_collection(result.url, "test", fetched=result)
 
     # Example of adding a PDF file
     pdf_file_path = "path/to/your/document.pdf"  # Replace with your PDF file path
@@ -0,0 +1,137 @@
+"""
+Семантический кэш ответов: если новый вопрос по эмбеддингу почти совпадает с уже отвеченным
+по тем же коллекциям той же версии и той же моделью, ответ и источники отдаются из кэша без поиска и генерации
+"""
+import os
+import time
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from collection_registry import collection_versions
+
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "2048"))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "3600"))
+# Косинусная близость вопросов, начиная с которой ответ переиспользуется
+ANSWER_CACHE_MIN_SIMILARITY = float(os.getenv("ANSWER_CACHE_MIN_SIMILARITY", "0.97"))
+
+
+class AnswerCache:
+    def __init__(self, max_size: int = ANSWER_CACHE_SIZE, ttl: float = ANSWER_CACHE_TTL,
+                 min_similarity: float = ANSWER_CACHE_MIN_SIMILARITY):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.min_similarity = min_similarity
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.invalidated = 0
+        # (коллекции, модель) -> {id записи: (эмбеддинг, версии коллекций, чанки ответа, источники, время)}
+        self._groups = {}
+        self._matrices = {}  # (коллекции, модель) -> (id записей, нормированные эмбеддинги)
+        self._order = OrderedDict()  # id записи -> группа, от старых к новым
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _group(collection_names, model_key: str):
+        return tuple(sorted(collection_names)), model_key
+
+    @staticmethod
+    def versions(collection_names) -> tuple:
+        return tuple(collection_versions.get(name) for name in sorted(collection_names))
+
+    def lookup(self, query_embedding, collection_names, model_key: str, versions: tuple = None):
+        """
+        Args:
+            versions (tuple, optional): Текущие версии коллекций, если уже прочитаны
+
+        Returns:
+            tuple: (чанки ответа, источники) или None
+        """
+        group = self._group(collection_names, model_key)
+        versions = self.versions(collection_names) if versions is None else versions
+        query = np.asarray(query_embedding, dtype=np.float32)
+        query = query / max(float(np.linalg.norm(query)), 1e-12)
+        now = time.time()
+        with self._lock:
+            entries = self._groups.get(group)
+            if entries:
+                ids, matrix = self._matrix(group)
+                similarities = matrix @ query
+                # Сначала отбрасываем устаревшие записи группы, лучший ответ выбирается только среди живых
+                valid = np.ones(len(ids), dtype=bool)
+                for i, entry_id in enumerate(ids):
+                    _, entry_versions, _, _, created_at = entries[entry_id]
+                    if now - created_at > self.ttl:
+                        self.expired += 1
+                    elif entry_versions != versions:
+                        # В коллекцию что-то загрузили после ответа
+                        self.invalidated += 1
+                    else:
+                        continue
+                    valid[i] = False
+                    self._remove(entry_id)
+                if valid.any():
+                    best = int(np.argmax(np.where(valid, similarities, -np.inf)))
+                    if similarities[best] >= self.min_similarity:
+                        self.hits += 1
+                        _, _, chunks, sources, _ = entries[ids[best]]
+                        return chunks, sources
+            self.misses += 1
+            return None
+
+    def put(self, query_embedding, collection_names, model_key: str, versions: tuple, chunks: list, sources: list):
+        """
+        Args:
+            versions (tuple): Версии коллекций на момент поиска (AnswerCache.versions до поиска)
+        """
+        group = self._group(collection_names, model_key)
+        query = np.asarray(query_embedding, dtype=np.float32)
+        query = query / max(float(np.linalg.norm(query)), 1e-12)
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            self._groups.setdefault(group, {})[entry_id] = (query, versions, list(chunks), list(sources), time.time())
+            self._order[entry_id] = group
+            self._matrices.pop(group, None)
+            while len(self._order) > self.max_size:
+                self._remove(next(iter(self._order)))
+
+    def _matrix(self, group):
+        cached = self._matrices.get(group)
+        if cached is None:
+            entries = self._groups[group]
+            ids = list(entries)
+            cached = ids, np.stack([entries[entry_id][0] for entry_id in ids])
+            self._matrices[group] = cached
+        return cached
+
+    def _remove(self, entry_id: int):
+        group = self._order.pop(entry_id)
+        entries = self._groups[group]
+        del entries[entry_id]
+        if not entries:
+            del self._groups[group]
+        self._matrices.pop(group, None)
+
+    def invalidate(self, collection_name: str = None):
+        """Удаляет ответы по коллекции (или все). Обычно не нужно: записи с устаревшей версией отбрасываются сами"""
+        with self._lock:
+            for entry_id, group in list(self._order.items()):
+                if collection_name is None or collection_name in group[0]:
+                    self._remove(entry_id)
+                    self.invalidated += 1
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._order), "max_size": self.max_size, "hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0, "expired": self.expired,
+                "invalidated": self.invalidated
+            }
+
+
+answer_cache = AnswerCache()
@@ -1,12 +1,16 @@
 import os
 import json
+import time
+import asyncio
+import uuid
+import hashlib
 import logging
 import traceback
 from datetime import datetime
 from typing import Optional, Literal, Dict, Any, List
 
-import chromadb
 import aiofiles
+import aiofiles.os
 import mimetypes
 import aiohttp
 import urllib.parse
@@ -30,12 +34,20 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # Import local modules
-from engine import model, prompt_template, semantic_search
-from add_data import add_into_collection
-from db import (get_db_connection, create_storage, list_storages, check_storage_nickname_exists, check_existing_records,
-                get_chats, create_chat, get_chat_history, create_chat_history, list_models, get_last_n_messages,
-                update_storage, get_storage_files, get_file_details, get_storage_by_id, add_url_to_storage_collection,
-                save_file, delete_storage_file, update_file_info)
+from engine import (model, prompt_template, asearch_collections, encode_query, run_in_embed_executor,
+                    query_embedding_cache)
+from answer_cache import answer_cache
+from embedding_cache import embedding_cache
+from context_packer import pack_context, CHUNK_SEPARATOR
+import async_db
+from jobs import ingestion_workers
+from summaries import chat_summarizer, summary_prompt_suffix
+from collection_registry import storage_collection_name
+from async_db import (create_storage, list_storages, check_storage_nickname_exists, check_existing_records,
+                      get_chats, create_chat, get_chat_history, create_chat_history, create_chat_exchange, list_models,
+                      get_last_n_messages, update_storage, get_storage_files, get_file_details, get_storage_by_id,
+                      add_url_to_storage_collection, save_file, delete_storage_file, update_file_info,
+                      get_ingest_job, get_context_window, get_chat_summary)
 
 
 # Utility Functions
@@ -75,18 +87,82 @@ def validate_url(url: str) -> bool:
         return False
 
 
-def validate_file_size(file: UploadFile, max_size: int = 50 * 1024 * 1024) -> bool:
+MAX_UPLOAD_SIZE = 50 * 1024 * 1024
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+class UploadTooLarge(ValueError):
+    pass
+
+
+async def save_upload_stream(file: UploadFile, upload_dir: str, filename: str, max_size: int = MAX_UPLOAD_SIZE):
     """
-    Validate file size
+    Stream upload to disk chunk by chunk, checking size and computing sha256 on the fly.
+    File is written to a temp file in upload_dir and atomically renamed when complete
     
     Args:
         file (UploadFile): Uploaded file
+        upload_dir (str): Destination directory
+        filename (str): Destination file name
         max_size (int): Maximum file size in bytes
     
     Returns:
-        bool: Whether file size is acceptable
+        tuple: (local path, sha256 hex digest, size in bytes)
+    """
+    await aiofiles.os.makedirs(upload_dir, exist_ok=True)
+    local_path = os.path.join(upload_dir, filename)
+    tmp_path = os.path.join(upload_dir, f".{uuid.uuid4().hex}.part")
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        async with aiofiles.open(tmp_path, 'wb') as f:
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                size += len(chunk)
+                if size > max_size:
+                    raise UploadTooLarge(f"File exceeds maximum size of {max_size // (1024 * 1024)}MB")
+                digest.update(chunk)
+                await f.write(chunk)
+        await aiofiles.os.replace(tmp_path, local_path)
+    except BaseException:
+        if await aiofiles.os.path.exists(tmp_path):
+            await aiofiles.os.remove(tmp_path)
+        raise
+    return local_path, digest.hexdigest(), size
+
+
+# Коллекция для чатов без storage_id / collection_name, как раньше
+DEFAULT_COLLECTION = os.getenv("DEFAULT_COLLECTION", "test")
+# Пока клиенты не передают storage_id в чат, загрузки в хранилище дублируются в коллекцию по умолчанию.
+# Повторная индексация дешёвая: эмбеддинги окон берутся из embedding_cache
+MIRROR_UPLOADS_TO_DEFAULT = os.getenv("MIRROR_UPLOADS_TO_DEFAULT", "1") == "1"
+
+
+async def submit_ingest(source: str, collection_name: str, storage_id: Optional[int] = None):
+    """Ставит источник в очередь индексации, возвращает задачу основной коллекции"""
+    job = await ingestion_workers.submit(source, collection_name, storage_id)
+    if MIRROR_UPLOADS_TO_DEFAULT and collection_name != DEFAULT_COLLECTION:
+        await ingestion_workers.submit(source, DEFAULT_COLLECTION)
+    return job
+
+
+async def resolve_collection_names(data: dict) -> List[str]:
+    """
+    Resolve Chroma collections for request. storage_ids / storage_id map to the storages' collections,
+    otherwise explicit collection_names / collection_name or DEFAULT_COLLECTION
+    
+    Args:
+        data (dict): Request body
+    
+    Returns:
+        List[str]: Collection names
     """
-    return file.size <= max_size if hasattr(file, 'size') else True
+    storage_ids = data.get('storage_ids') or ([data['storage_id']] if data.get('storage_id') is not None else [])
+    if storage_ids:
+        storages = await asyncio.gather(*[get_storage_by_id(int(storage_id)) for storage_id in storage_ids])
+        return [storage_collection_name(storage) for storage in storages]
+    if data.get('collection_names'):
+        return list(data['collection_names'])
+    return [data.get('collection_name', DEFAULT_COLLECTION)]
 
 
 def get_file_type(filename: str) -> str:
@@ -139,9 +215,6 @@ class ChatHistoryCreate(BaseModel):
     author: Literal['user', 'model']
 
 
-# ChromaDB Client
-chroma_client = chromadb.HttpClient(host='localhost', port=8027)
-
 # FastAPI App
 app = FastAPI()
 
@@ -153,26 +226,97 @@ app.add_middleware(
 
 
 # Async RAG Query Function
-async def query_simple_rag_stream(query: str, collection_name: str, chat_id: int):
+class StageTimings:
+    """Накопленные длительности этапов RAG запросов, отдаются в /metrics/rag"""
+
+    def __init__(self):
+        self._stages = {}
+
+    def record(self, timings: dict):
+        for stage, seconds in timings.items():
+            count, total, worst = self._stages.get(stage, (0, 0.0, 0.0))
+            self._stages[stage] = (count + 1, total + seconds, max(worst, seconds))
+
+    def stats(self):
+        return {
+            stage: {"count": count, "avg_ms": total / count * 1000, "max_ms": worst * 1000}
+            for stage, (count, total, worst) in self._stages.items()
+        }
+
+
+rag_timings = StageTimings()
+
+
+# Сколько последних сообщений читается из истории, что из них влезет - решает pack_context
+HISTORY_MAX_MESSAGES = int(os.getenv("HISTORY_MAX_MESSAGES", "20"))
+
+
+async def load_chat_context(chat_id: int, model_name: Optional[str], timings: dict):
+    """
+    Returns:
+        tuple: (сообщения истории после сводки, context_window модели или None, текст сводки или "")
+    """
+    started = time.perf_counter()
     try:
-        results = semantic_search(query, collection_name)
+        messages, context_window, summary = await asyncio.gather(
+            get_last_n_messages(chat_id, HISTORY_MAX_MESSAGES), get_context_window(chat_id, model_name),
+            get_chat_summary(chat_id)
+        )
+        if summary:
+            # Уже свёрнутые в сводку сообщения в промпт не дублируются
+            messages = [i for i in messages if i['id'] > summary['last_message_id']]
+        history = [HumanMessage(i['text']) if i['author'] == 'user' else AIMessage(i['text']) for i in messages]
+        return history, context_window, summary['summary'] if summary else ""
+    finally:
+        timings['history'] = time.perf_counter() - started
 
-        context_text = "\n\n---\n\n".join(results['documents'][0])
-        sources = list(set([i.get("url", "pdf source") for i in results['metadatas'][0]]))
 
-        history = []
-        for i in get_last_n_messages(chat_id, 5):
-            history.append(
-                HumanMessage(i['text']) if i['author'] == 'user' else AIMessage(i['text'])
-            )
+async def retrieve_with_history(query: str, collection_names: List[str], chat_id: int, timings: dict,
+                                model_name: Optional[str] = None):
+    """
+    Поиск по коллекциям и чтение истории чата идут одновременно.
+    Возвращает результаты поиска, как только они готовы, и задачу, которая дочитывает историю
+    """
+    history_task = asyncio.create_task(load_chat_context(chat_id, model_name, timings))
+    try:
+        results = await asearch_collections(query, collection_names, timings=timings)
+    except Exception:
+        history_task.cancel()
+        raise
+    return results, history_task
 
-        system_message_content = prompt_template.format(
-            context=context_text, question=query
+
+async def await_history(history_task: asyncio.Task):
+    # Ответ уже начал стримиться, поэтому без истории лучше, чем оборванный поток
+    try:
+        return await history_task
+    except Exception as e:
+        logger.error(f"Could not load chat history: {e}")
+        return [], None, ""
+
+
+def pack_prompt(fixed_text: str, documents: list, history: list, context_window: Optional[int], timings: dict):
+    started = time.perf_counter()
+    packed = pack_context(fixed_text, documents, history, context_window, history_text=lambda msg: msg.content)
+    timings['pack'] = time.perf_counter() - started
+    if packed.dropped_chunks or packed.dropped_messages:
+        logger.info(
+            f"Prompt packed into {packed.tokens} tokens (window {context_window}): "
+            f"dropped {packed.dropped_chunks} chunks, {packed.dropped_messages} messages"
+        )
+    return packed
+
+
+async def query_simple_rag_stream(query: str, collection_names: List[str], chat_id: int, timings: dict = None):
+    timings = {} if timings is None else timings
+    try:
+        # Окно ищется по id модели Ollama, которой идёт генерация, а не по модели чата
+        results, history_task = await retrieve_with_history(
+            query, collection_names, chat_id, timings, model_name=model.model
         )
-        prompt = [SystemMessage(system_message_content)] + history
 
-        response_stream = model.astream(prompt)
-        return response_stream, sources
+        documents = results['documents'][0]
+        sources = list(set([i.get("url", "pdf source") for i in results['metadatas'][0]]))
 
     except Exception as e:
         logger.error(f"RAG Query Error: {e}")
@@ -180,9 +324,26 @@ async def query_simple_rag_stream(query: str, collection_name: str, chat_id: int
             status_code=500, detail=f"Error processing RAG query: {str(e)}"
         )
 
+    async def response_stream():
+        history, context_window, summary = await await_history(history_task)
+        packed = pack_prompt(
+            prompt_template.format(context="", question=query) + summary_prompt_suffix(summary),
+            documents, history, context_window, timings
+        )
+        system_message_content = prompt_template.format(
+            context=CHUNK_SEPARATOR.join(packed.chunks), question=query
+        ) + summary_prompt_suffix(summary)
+        prompt = [SystemMessage(system_message_content)] + packed.history
+        async for chunk in model.astream(prompt):
+            yield chunk
+
+    return response_stream(), sources
+
 
 # New function for OpenAI model query
-async def query_openai_model_stream(query: str, token: str, selected_model: str, chat_id: int):
+async def query_openai_model_stream(query: str, token: str, selected_model: str, chat_id: int,
+                                    collection_names: List[str] = (DEFAULT_COLLECTION,), timings: dict = None):
+    timings = {} if timings is None else timings
     try:
         # Initialize the OpenAI model
         llm = ChatOpenAI(
@@ -190,33 +351,54 @@ async def query_openai_model_stream(query: str, token: str, selected_model: str,
             base_url="https://lk.neuroapi.host/v1"
         )
 
-        # Prepare the context and history
-        results = semantic_search(query, "test")
-        context_text = "\n\n---\n\n".join(results['documents'][0])
+        # Prepare the context while the history is being loaded
+        results, history_task = await retrieve_with_history(
+            query, collection_names, chat_id, timings, model_name=selected_model
+        )
+        documents = results['documents'][0]
         sources = list(set([i.get("url", "pdf source") for i in results['metadatas'][0]]))
 
-        history = []
-        for i in get_last_n_messages(chat_id, 5):
-            history.append(
-                HumanMessage(i['text']) if i['author'] == 'user' else AIMessage(i['text'])
-            )
+    except Exception as e:
+        logger.error(f"OpenAI Query Error: {e}")
+        raise HTTPException(
+            status_code=500, detail=f"Error processing OpenAI query: {str(e)}"
+        )
+
+    async def response_stream():
+        history, context_window, summary = await await_history(history_task)
 
         # Prepare the prompt
-        system_message_content = f"Answer the question based only on the following context:\n{context_text}\n---\n{query}"
+        system_prompt = "Answer the question based only on the following context:\n{context}\n---\n{query}"
+        system_prompt += summary_prompt_suffix(summary).replace("{", "{{").replace("}", "}}")
+        packed = pack_prompt(system_prompt.format(context="", query=query), documents, history, context_window, timings)
+        system_message_content = system_prompt.format(context=CHUNK_SEPARATOR.join(packed.chunks), query=query)
         prompt = [{"role": "system", "content": system_message_content}] + [
             {"role": "user" if isinstance(msg, HumanMessage) else "assistant", "content": msg.content}
-            for msg in history
+            for msg in packed.history
         ]
 
         # Generate response
-        response = llm.astream(prompt)
-        return response, sources
+        async for chunk in llm.astream(prompt):
+            yield chunk
+
+    return response_stream(), sources
 
+
+@app.on_event("startup")
+async def open_db_pool():
+    try:
+        await async_db.init_pool()
     except Exception as e:
-        logger.error(f"OpenAI Query Error: {e}")
-        raise HTTPException(
-            status_code=500, detail=f"Error processing OpenAI query: {str(e)}"
-        )
+        logger.error(f"Could not pre-open database connections: {e}")
+    # Воркеры стартуют и без базы: пул откроется при первом удачном запросе
+    await ingestion_workers.start()
+
+
+@app.on_event("shutdown")
+async def close_db_pool():
+    await ingestion_workers.stop()
+    await chat_summarizer.stop()
+    await async_db.close_pool()
 
 
 # Root Endpoint
@@ -225,6 +407,48 @@ async def root():
     return PlainTextResponse("Window of Knowledge Backend")
 
 
+# RAG Stage Timings Endpoint
+@app.get("/metrics/rag")
+async def rag_metrics():
+    return JSONResponse(
+        content={"status": "success", "data": rag_timings.stats()}
+    )
+
+
+# Answer Cache Metrics Endpoint
+@app.get("/metrics/answer-cache")
+async def answer_cache_metrics():
+    return JSONResponse(
+        content={"status": "success", "data": answer_cache.stats()}
+    )
+
+
+# Query Embedding Cache Metrics Endpoint
+@app.get("/metrics/query-cache")
+async def query_cache_metrics():
+    return JSONResponse(
+        content={"status": "success", "data": query_embedding_cache.stats()}
+    )
+
+
+# Embedding Cache Metrics Endpoint
+@app.get("/metrics/embedding-cache")
+async def embedding_cache_metrics():
+    # COUNT(*) по SQLite не должен держать event loop
+    stats = await asyncio.to_thread(embedding_cache.stats)
+    return JSONResponse(
+        content={"status": "success", "data": stats}
+    )
+
+
+# Database Pool Metrics Endpoint
+@app.get("/metrics/db-pool")
+async def db_pool_metrics():
+    return JSONResponse(
+        content={"status": "success", "data": async_db.pool_stats()}
+    )
+
+
 # File Upload Endpoint
 @app.post("/storages/{storage_id}/files", response_model=Dict[str, Any])
 async def upload_file(storage_id: int, file: UploadFile = File(...), description: Optional[str] = Form(None)):
@@ -241,31 +465,19 @@ async def upload_file(storage_id: int, file: UploadFile = File(...), description
     """
     try:
         # Validate storage
-        storage = get_storage_by_id(storage_id)
-
-        # Validate file
-        if not validate_file_size(file):
-            raise ValueError("File exceeds maximum size of 50MB")
+        storage = await get_storage_by_id(storage_id)
 
-        # Create storage-specific upload directory
+        # Generate unique filename and stream file to storage-specific upload directory
         upload_dir = os.path.join(os.getcwd(), 'uploads', str(storage_id))
-        os.makedirs(upload_dir, exist_ok=True)
-
-        # Generate unique filename
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         safe_filename = f"{timestamp}_{file.filename}"
-        local_path = os.path.join(upload_dir, safe_filename)
-
-        # Save file
-        async with aiofiles.open(local_path, 'wb') as f:
-            content = await file.read()
-            await f.write(content)
+        local_path, content_hash, size = await save_upload_stream(file, upload_dir, safe_filename)
 
         # Determine file type
         file_type = get_file_type(file.filename)
 
         # Save to database
-        file_info = save_file(
+        file_info = await save_file(
             storage_id=storage_id, 
             filename=file.filename, 
             local_path=local_path, 
@@ -276,7 +488,10 @@ async def upload_file(storage_id: int, file: UploadFile = File(...), description
 
         return JSONResponse(
             status_code=status.HTTP_201_CREATED,
-            content={"status": "success", "message": "File uploaded successfully", "file": file_info}
+            content={
+                "status": "success", "message": "File uploaded successfully", "file": file_info,
+                "sha256": content_hash, "size": size
+            }
         )
 
     except Exception as e:
@@ -301,20 +516,42 @@ async def add_url_endpoint(request: Request):
                 status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid URL format"
             )
 
-        add_into_collection(url, "test")
+        collection_name = (await resolve_collection_names(data))[0]
+        job = await submit_ingest(url, collection_name, data.get('storage_id'))
         return JSONResponse(
-            content={"status": "success", "message": "Data added successfully"}
+            status_code=status.HTTP_202_ACCEPTED,
+            content={"status": "success", "message": "URL queued for processing", "job_id": job['id']}
         )
 
     except Exception as e:
         return handle_exception(e)
 
 
+# Ingest Job Status Endpoint
+@app.get("/jobs/{job_id}")
+async def get_job_status(job_id: int):
+    """
+    Get status of a background ingestion job
+    
+    Args:
+        job_id: int - ID of job returned by /add-url or /upload-pdf
+    
+    Returns:
+        Job record with status, current stage and per-stage timings in seconds
+    """
+    try:
+        return await get_ingest_job(job_id)
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail=str(e)
+        )
+
+
 # Storage Creation Endpoint
 @app.post("/storages")
 async def create_storage_endpoint(storage: StorageCreate):
     try:
-        result = create_storage(storage.name, storage.description)
+        result = await create_storage(storage.name, storage.description)
         return JSONResponse(
             content={"status": "success", "data": result}
         )
@@ -338,7 +575,7 @@ async def update_storage_endpoint(storage_id: int, storage_data: StorageUpdate):
         Updated storage record
     """
     try:
-        return update_storage(
+        return await update_storage(
             storage_id=storage_id, name=storage_data.name, description=storage_data.description
         )
     except ValueError as e:
@@ -347,23 +584,45 @@ async def update_storage_endpoint(storage_id: int, storage_data: StorageUpdate):
         )
 
 
+def wants_history(data: dict, chat_id) -> bool:
+    """
+    save_history=true: сервер сам записывает вопрос и ответ после стрима, отдельный POST /chat_history не нужен.
+    По умолчанию выключено - клиенты, которые пишут историю сами, не получат дублей
+    """
+    return bool(data.get('save_history', False)) and chat_id is not None
+
+
+async def save_exchange(chat_id: int, query: str, answer: list):
+    """Общий путь записи для /chatting и /chatting_v2, ошибка записи не обрывает стрим"""
+    try:
+        await create_chat_exchange(chat_id, query, "".join(answer))
+        chat_summarizer.schedule(chat_id)
+    except Exception as e:
+        logger.error(f"Could not save chat {chat_id} exchange: {e}")
+
+
 # Chatting Endpoint
 @app.get('/chatting')
 async def chat_endpoint(request: Request):
     try:
         data = await request.json()
         query = data.get('query')
-        collection_name = data.get('collection_name', 'test')
+        collection_names = await resolve_collection_names(data)
         chat_id = data.get('chat_id')
+        save_history = wants_history(data, chat_id)
 
-        response_stream, sources = await query_simple_rag_stream(query, collection_name, chat_id)
+        response_stream, sources = await query_simple_rag_stream(query, collection_names, chat_id)
 
         async def event_generator():
             # First, send the sources as a JSON event
             yield f"data: {json.dumps({'sources': sources})}\n\n"
             # Now, send the response content as events
+            answer = []
             async for chunk in response_stream:
+                answer.append(chunk)
                 yield f"data: {json.dumps({'content': chunk})}\n\n"
+            if save_history:
+                await save_exchange(chat_id, query, answer)
 
         return StreamingResponse(event_generator(), media_type='text/event-stream')
 
@@ -371,34 +630,71 @@ async def chat_endpoint(request: Request):
         return handle_exception(e)
 
 
+async def replay_chunks(chunks: list):
+    for chunk in chunks:
+        yield chunk
+
+
 # Chatting V2 Endpoint
 @app.post('/chatting_v2')
 async def chat_endpoint_v2(request: Request):
     try:
         data = await request.json()
         query = data.get('query')
-        collection_name = data.get('collection_name', 'test')
+        collection_names = await resolve_collection_names(data)
         chat_id = data.get('chat_id')
         token = data.get('token', '')
         selected_model = data.get('selected_model', '')
         with_gpt = data.get('with_gpt', False)
-
-        if with_gpt and token and selected_model:
-            response_stream, sources = await query_openai_model_stream(query, token, selected_model, chat_id)
+        save_history = wants_history(data, chat_id)
+
+        started = time.perf_counter()
+        timings = {}
+        use_gpt = bool(with_gpt and token and selected_model)
+        model_key = f"openai:{selected_model}" if use_gpt else "local"
+
+        # Почти такой же вопрос по тем же данным уже отвечен - отдаём ответ из кэша без поиска и генерации
+        query_embedding = await run_in_embed_executor(encode_query, query)
+        versions = answer_cache.versions(collection_names)
+        cached = answer_cache.lookup(query_embedding, collection_names, model_key, versions)
+        timings['cache'] = time.perf_counter() - started
+        if cached is not None:
+            cached_chunks, sources = cached
+            response_stream = replay_chunks(cached_chunks)
+        elif use_gpt:
+            response_stream, sources = await query_openai_model_stream(
+                query, token, selected_model, chat_id, collection_names, timings
+            )
         else:
-            response_stream, sources = await query_simple_rag_stream(query, collection_name, chat_id)
+            response_stream, sources = await query_simple_rag_stream(query, collection_names, chat_id, timings)
 
         async def event_generator():
-            # First, send the sources as a JSON event
+            # First, send the sources as a JSON event (history may still be loading)
             yield f"data: {json.dumps({'sources': sources})}\n\n"
             # Now, send the response content as events
-            async for chunk in response_stream:
-                # Convert chunk to string for JSON serialization
-                if isinstance(chunk, str):
-                    chunk_content = chunk
-                else:
-                    chunk_content = chunk.content  # Fallback to string conversion
-                yield f"data: {json.dumps({'content': chunk_content})}\n\n"
+            answer = []
+            try:
+                async for chunk in response_stream:
+                    if 'first_token' not in timings:
+                        timings['first_token'] = time.perf_counter() - started
+                    # Convert chunk to string for JSON serialization
+                    if isinstance(chunk, str):
+                        chunk_content = chunk
+                    else:
+                        chunk_content = chunk.content  # Fallback to string conversion
+                    answer.append(chunk_content)
+                    yield f"data: {json.dumps({'content': chunk_content})}\n\n"
+                if cached is None and answer:
+                    answer_cache.put(query_embedding, collection_names, model_key, versions, answer, sources)
+                # Запись до закрытия стрима: следующий вопрос уже увидит этот ответ в истории
+                if save_history:
+                    await save_exchange(chat_id, query, answer)
+            finally:
+                timings['total'] = time.perf_counter() - started
+                rag_timings.record(timings)
+                logger.info(
+                    f"Chat {chat_id} timings: " + ", ".join(f"{k}={v * 1000:.0f}ms" for k, v in timings.items())
+                )
 
         return StreamingResponse(event_generator(), media_type='text/event-stream')
 
@@ -410,7 +706,7 @@ async def chat_endpoint_v2(request: Request):
 @app.get("/list_storages")
 async def list_storages_endpoint():
     try:
-        result = list_storages()
+        result = await list_storages()
         return JSONResponse(
             content={"status": "success", "data": result}
         )
@@ -422,7 +718,7 @@ async def list_storages_endpoint():
 @app.get("/check-records")
 async def check_records_endpoint():
     try:
-        result = check_existing_records()
+        result = await check_existing_records()
         return JSONResponse(
             content={"status": "success", "data": result}
         )
@@ -443,7 +739,7 @@ async def list_storage_files(storage_id: int):
         List of files in storage
     """
     try:
-        return get_storage_files(storage_id)
+        return await get_storage_files(storage_id)
     except ValueError as e:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, detail=str(e)
@@ -464,7 +760,7 @@ async def get_file_info(storage_id: int, file_id: int):
         File information including metadata
     """
     try:
-        return get_file_details(storage_id, file_id)
+        return await get_file_details(storage_id, file_id)
     except ValueError as e:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, detail=str(e)
@@ -480,7 +776,7 @@ async def list_chats():
     Returns:
         List of chat records
     """
-    return get_chats()
+    return await get_chats()
 
 
 # Create Chat Endpoint
@@ -495,7 +791,7 @@ async def add_chat(chat_data: ChatCreate):
     Returns:
         Dict representing the newly created chat
     """
-    return create_chat(
+    return await create_chat(
         name=chat_data.name, model_id=chat_data.model_id
     )
 
@@ -511,7 +807,7 @@ async def retrieve_chat_history(chat_id: int):
     Returns:
         List of chat history records
     """
-    return get_chat_history(chat_id)
+    return await get_chat_history(chat_id)
 
 
 @app.post("/chat_history")
@@ -525,9 +821,11 @@ async def save_chat_history(chat_history: ChatHistoryCreate):
     Returns:
         Dict representing the newly created chat history entry
     """
-    return create_chat_history(
+    entry = await create_chat_history(
         chat_id=chat_history.chat_id, text=chat_history.text, author=chat_history.author
     )
+    chat_summarizer.schedule(chat_history.chat_id)
+    return entry
 
 
 @app.get("/models")
@@ -538,7 +836,7 @@ async def get_models():
     Returns:
         List of model records
     """
-    return list_models()
+    return await list_models()
 
 
 @app.delete("/storages/{storage_id}/files/{file_id}")
@@ -554,11 +852,11 @@ async def delete_file(storage_id: int, file_id: int):
         Success status
     """
     try:
-        local_path = delete_storage_file(storage_id, file_id)
+        local_path = await delete_storage_file(storage_id, file_id)
 
         # Delete physical file if it exists
-        if os.path.exists(local_path):
-            os.remove(local_path)
+        if await aiofiles.os.path.exists(local_path):
+            await aiofiles.os.remove(local_path)
 
         return JSONResponse(
             content={"status": "success", "message": "File deleted"}
@@ -586,7 +884,7 @@ async def update_file_metadata(storage_id: int, file_id: int, metadata: dict = B
         Updated file information
     """
     try:
-        result = update_file_info(storage_id, file_id, metadata)
+        result = await update_file_info(storage_id, file_id, metadata)
         return JSONResponse(
             content={"status": "success", "data": result}
         )
@@ -635,7 +933,7 @@ async def upload_pdf(
     """
     try:
         # Validate storage
-        storage = get_storage_by_id(storage_id)
+        storage = await get_storage_by_id(storage_id)
 
         # Validate PDF format
         if not validate_pdf(file):
@@ -644,40 +942,26 @@ async def upload_pdf(
                 detail="Invalid file format. Only PDF files are allowed."
             )
 
-        # Validate file size (50MB limit)
-        if not validate_file_size(file):
-            raise HTTPException(
-                status_code=400,
-                detail="File exceeds maximum size of 50MB"
-            )
-
-        # Create storage-specific upload directory
+        # Generate unique filename and stream file to storage-specific upload directory (50MB limit)
         upload_dir = os.path.join(os.getcwd(), 'uploads', str(storage_id))
-        os.makedirs(upload_dir, exist_ok=True)
-
-        # Generate unique filename
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         safe_filename = f"{timestamp}_{file.filename}"
-        local_path = os.path.join(upload_dir, safe_filename)
-
-        # Save file
-        async with aiofiles.open(local_path, 'wb') as f:
-            content = await file.read()
-            await f.write(content)
-
-        # Process PDF for vector storage
         try:
-            add_into_collection(local_path, f"test")
-        except Exception as e:
-            logger.error(f"Error processing PDF for vector storage: {e}")
-            # Continue even if vector processing fails
-            # You may want to add a status flag in the response
+            local_path, content_hash, size = await save_upload_stream(file, upload_dir, safe_filename)
+        except UploadTooLarge as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+        # Process PDF for vector storage in background, progress via /jobs/{job_id}
+        job = await submit_ingest(local_path, storage_collection_name(storage), storage_id)
 
         return JSONResponse(
-            status_code=status.HTTP_201_CREATED,
+            status_code=status.HTTP_202_ACCEPTED,
             content={
                 "status": "success",
-                "message": "PDF uploaded and processed successfully"
+                "message": "PDF uploaded and queued for processing",
+                "job_id": job['id'],
+                "sha256": content_hash,
+                "size": size
             }
         )
 
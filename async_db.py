@@ -0,0 +1,617 @@
+"""
+Слой доступа к Postgres на asyncpg со своим пулом соединений.
+Используется в обработчиках FastAPI, чтобы запросы к базе не блокировали event loop
+"""
+import os
+import time
+import json
+import random
+import string
+import logging
+from datetime import datetime
+from contextlib import asynccontextmanager
+
+import asyncpg
+
+logger = logging.getLogger(__name__)
+
+pool = None
+_pool_stats = {"checkouts": 0, "total_wait": 0.0, "max_wait": 0.0}
+
+
+async def _init_connection(conn):
+    # Без кодеков asyncpg отдаёт json/jsonb строкой
+    for type_name in ('json', 'jsonb'):
+        await conn.set_type_codec(type_name, encoder=json.dumps, decoder=json.loads, schema='pg_catalog')
+
+
+async def init_pool():
+    global pool
+    if pool is None:
+        pool = await asyncpg.create_pool(
+            database=os.getenv("POSTGRES_DB", "jiraiya"), user=os.getenv("POSTGRES_USER", "jiraiya"),
+            password=os.getenv("POSTGRES_PASSWORD", "password"), host=os.getenv("POSTGRES_HOST", "localhost"),
+            port=int(os.getenv("POSTGRES_PORT", "8012")),
+            min_size=int(os.getenv("POSTGRES_POOL_MIN", "1")), max_size=int(os.getenv("POSTGRES_POOL_MAX", "10")),
+            max_inactive_connection_lifetime=300, init=_init_connection
+        )
+    return pool
+
+
+async def close_pool():
+    global pool
+    if pool is not None:
+        await pool.close()
+        pool = None
+
+
+@asynccontextmanager
+async def db_connection():
+    if pool is None:
+        await init_pool()
+    started = time.monotonic()
+    async with pool.acquire(timeout=float(os.getenv("POSTGRES_POOL_TIMEOUT", "30"))) as conn:
+        waited = time.monotonic() - started
+        _pool_stats["checkouts"] += 1
+        _pool_stats["total_wait"] += waited
+        _pool_stats["max_wait"] = max(_pool_stats["max_wait"], waited)
+        yield conn
+
+
+def pool_stats():
+    if pool is None:
+        return {"initialized": False}
+    checkouts = _pool_stats["checkouts"]
+    return {
+        "initialized": True, "min": pool.get_min_size(), "max": pool.get_max_size(), "size": pool.get_size(),
+        "idle": pool.get_idle_size(), "in_use": pool.get_size() - pool.get_idle_size(), "checkouts": checkouts,
+        "avg_wait": _pool_stats["total_wait"] / checkouts if checkouts else 0.0, "max_wait": _pool_stats["max_wait"]
+    }
+
+
+def serialize_datetime(obj):
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    return obj
+
+
+def serialize_db_result(result):
+    if not result:
+        return None
+    serialized = {}
+    for key, value in result.items():
+        serialized[key] = serialize_datetime(value)
+    return serialized
+
+
+def generate_valid_nickname(name: str) -> str:
+    # Создаем базовый nickname из имени, оставляя только допустимые символы
+    base = ''.join(c if c.isalnum() or c in '-_' else '' for c in name.lower())
+
+    # Если базовый nickname пустой, используем 'storage'
+    if not base:
+        base = 'storage'
+
+    # Добавляем случайный суффикс
+    random_suffix = ''.join(random.choices(string.ascii_lowercase + string.digits, k=6))
+
+    # Убеждаемся, что nickname начинается с буквы
+    if not base[0].isalpha():
+        base = 'n' + base
+
+    # Формируем финальный nickname
+    nickname = f"{base}-{random_suffix}"
+
+    # Обрезаем до 63 символов если нужно
+    if len(nickname) > 63:
+        nickname = nickname[:56] + '-' + random_suffix
+
+    return nickname
+
+
+def _row(record):
+    return serialize_db_result(dict(record)) if record else None
+
+
+async def create_storage(name: str, description: str = None):
+    nickname = generate_valid_nickname(name)
+    logger.info(f"Generated nickname: {nickname}")
+    async with db_connection() as conn:
+        result = await conn.fetchrow(
+            """
+            INSERT INTO storages (name, description, nickname)
+            VALUES ($1, $2, $3)
+            RETURNING id, name, description, nickname, created_at, updated_at;
+            """,
+            name, description, nickname
+        )
+        return _row(result)
+
+
+async def list_storages():
+    async with db_connection() as conn:
+        results = await conn.fetch(
+            """
+            SELECT id, name, description, nickname, created_at, updated_at
+            FROM storages
+            ORDER BY created_at DESC;
+            """
+        )
+        return [_row(row) for row in results]
+
+
+async def check_storage_nickname_exists(nickname: str) -> bool:
+    async with db_connection() as conn:
+        return await conn.fetchval("SELECT EXISTS(SELECT 1 FROM storages WHERE nickname = $1);", nickname)
+
+
+async def check_existing_records():
+    async with db_connection() as conn:
+        results = await conn.fetch(
+            """
+            SELECT id, name, description, nickname, created_at, updated_at
+            FROM storages
+            ORDER BY id;
+            """
+        )
+        for row in results:
+            logger.info(f"Existing record: {dict(row)}")
+        return [_row(row) for row in results]
+
+
+async def get_chats():
+    async with db_connection() as conn:
+        chats = await conn.fetch("SELECT * FROM chats ORDER BY updated_at DESC")
+        return [_row(chat) for chat in chats]
+
+
+async def ensure_dummy_model(conn=None):
+    """
+    Ensure a dummy model exists in the models table.
+
+    Args:
+        conn (optional): Connection acquired by the caller
+    """
+    if conn is None:
+        async with db_connection() as conn:
+            return await ensure_dummy_model(conn)
+
+    existing_model = await conn.fetchrow("SELECT * FROM models WHERE id = 1")
+    if existing_model:
+        return _row(existing_model)
+
+    await conn.execute(
+        """
+        INSERT INTO models (id, name, model_path, type, context_window)
+        VALUES (1, 'Dummy Model', '/dev/null', 'service', 2048)
+        ON CONFLICT (id) DO NOTHING
+        """
+    )
+    return _row(await conn.fetchrow("SELECT * FROM models WHERE id = 1"))
+
+
+async def create_chat(name: str, model_id: int = None):
+    async with db_connection() as conn:
+        async with conn.transaction():
+            if model_id is None:
+                dummy_model = await ensure_dummy_model(conn)
+                model_id = dummy_model['id']
+            new_chat = await conn.fetchrow(
+                "INSERT INTO chats (name, model_id) VALUES ($1, $2) RETURNING *", name, model_id
+            )
+        return _row(new_chat)
+
+
+async def get_chat_history(chat_id: int):
+    async with db_connection() as conn:
+        history = await conn.fetch("SELECT * FROM chat_history WHERE chat_id = $1 ORDER BY created_at", chat_id)
+        return [_row(record) for record in history]
+
+
+async def list_models():
+    async with db_connection() as conn:
+        models = await conn.fetch("SELECT * FROM models ORDER BY created_at DESC")
+        return [_row(model) for model in models]
+
+
+async def get_context_window(chat_id: int, model_name: str = None):
+    """
+    context_window модели по имени или model_path (если передано), иначе модели чата.
+    None, если не нашлось. Служебная 'Dummy Model' (type = 'service') у чатов по умолчанию не настоящая модель,
+    её окно не используется
+    """
+    async with db_connection() as conn:
+        return await conn.fetchval(
+            """
+            SELECT COALESCE(
+                (SELECT context_window FROM models WHERE name = $2::text OR model_path = $2::text LIMIT 1),
+                (SELECT models.context_window FROM chats JOIN models ON models.id = chats.model_id
+                 WHERE chats.id = $1 AND models.type <> 'service')
+            )
+            """,
+            chat_id, model_name
+        )
+
+
+async def create_chat_history(chat_id: int, text: str, author: str):
+    async with db_connection() as conn:
+        async with conn.transaction():
+            if not await conn.fetchval("SELECT id FROM chats WHERE id = $1", chat_id):
+                raise ValueError(f"Chat with ID {chat_id} does not exist")
+            new_history_entry = await conn.fetchrow(
+                """
+                INSERT INTO chat_history (chat_id, text, author)
+                VALUES ($1, $2, $3)
+                RETURNING *
+                """,
+                chat_id, text, author
+            )
+        return _row(new_history_entry)
+
+
+async def create_chat_exchange(chat_id: int, user_text: str, model_text: str):
+    """
+    Сохраняет вопрос пользователя и ответ модели одним запросом (одна транзакция).
+    Ответ получает более позднее время, чтобы порядок в истории был однозначным
+    """
+    async with db_connection() as conn:
+        entries = await conn.fetch(
+            """
+            INSERT INTO chat_history (chat_id, text, author, created_at)
+            SELECT chats.id, message.text, message.author, message.created_at
+            FROM chats, (VALUES ($2::text, 'user', NOW()), ($3::text, 'model', clock_timestamp()))
+                AS message (text, author, created_at)
+            WHERE chats.id = $1
+            RETURNING *
+            """,
+            chat_id, user_text, model_text
+        )
+        if not entries:
+            raise ValueError(f"Chat with ID {chat_id} does not exist")
+        return [_row(entry) for entry in entries]
+
+
+async def get_last_n_messages(chat_id: int, n: int = 5):
+    async with db_connection() as conn:
+        messages = await conn.fetch(
+            """
+            SELECT * FROM chat_history
+            WHERE chat_id = $1
+            ORDER BY created_at DESC
+            LIMIT $2
+            """,
+            chat_id, n
+        )
+        # Reverse the messages to get them in chronological order
+        return [_row(msg) for msg in reversed(messages)]
+
+
+async def get_chat_summary(chat_id: int):
+    async with db_connection() as conn:
+        return _row(await conn.fetchrow("SELECT * FROM chat_summaries WHERE chat_id = $1", chat_id))
+
+
+async def get_messages_after(chat_id: int, message_id: int = 0, limit: int = None):
+    """Первые limit (по умолчанию все) сообщений чата с id больше message_id в хронологическом порядке"""
+    async with db_connection() as conn:
+        messages = await conn.fetch(
+            "SELECT * FROM chat_history WHERE chat_id = $1 AND id > $2 ORDER BY created_at, id LIMIT $3",
+            chat_id, message_id, limit
+        )
+        return [_row(msg) for msg in messages]
+
+
+async def save_chat_summary(chat_id: int, summary: str, last_message_id: int):
+    """Сводка не откатывается назад, если параллельно уже записали более свежую"""
+    async with db_connection() as conn:
+        await conn.execute(
+            """
+            INSERT INTO chat_summaries (chat_id, summary, last_message_id)
+            VALUES ($1, $2, $3)
+            ON CONFLICT (chat_id) DO UPDATE
+            SET summary = EXCLUDED.summary, last_message_id = EXCLUDED.last_message_id, updated_at = NOW()
+            WHERE chat_summaries.last_message_id < EXCLUDED.last_message_id
+            """,
+            chat_id, summary, last_message_id
+        )
+
+
+async def update_storage(storage_id: int, name: str, description: str = None):
+    async with db_connection() as conn:
+        if description is not None:
+            updated_storage = await conn.fetchrow(
+                """
+                UPDATE storages
+                SET name = $1, description = $2, updated_at = NOW()
+                WHERE id = $3
+                RETURNING *
+                """,
+                name, description, storage_id
+            )
+        else:
+            updated_storage = await conn.fetchrow(
+                """
+                UPDATE storages
+                SET name = $1, updated_at = NOW()
+                WHERE id = $2
+                RETURNING *
+                """,
+                name, storage_id
+            )
+        if not updated_storage:
+            raise ValueError(f"Storage with ID {storage_id} not found")
+        return _row(updated_storage)
+
+
+async def get_storage_files(storage_id: int):
+    try:
+        async with db_connection() as conn:
+            if not await conn.fetchrow("SELECT * FROM storages WHERE id = $1", storage_id):
+                logger.error(f"Storage with ID {storage_id} not found")
+                raise ValueError(f"Хранилище с ID {storage_id} не найдено")
+
+            files = await conn.fetch(
+                """
+                SELECT
+                    id, name, local_path, type, source,
+                    created_at, updated_at
+                FROM files
+                WHERE storage_id = $1
+                ORDER BY created_at DESC
+                """,
+                storage_id
+            )
+            logger.info(f"Retrieved {len(files)} files for storage {storage_id}")
+            return [_row(file) for file in files]
+    except Exception as e:
+        logger.error(f"Error retrieving files for storage {storage_id}: {e}")
+        raise ValueError(f"Не удалось получить файлы хранилища: {str(e)}")
+
+
+async def get_file_details(storage_id: int, file_id: int):
+    async with db_connection() as conn:
+        file = await conn.fetchrow(
+            """
+            SELECT f.*, m.metadata
+            FROM files f
+            JOIN storage_files sf ON f.id = sf.file_id
+            LEFT JOIN file_metadata m ON f.id = m.file_id
+            WHERE sf.storage_id = $1 AND f.id = $2
+            """,
+            storage_id, file_id
+        )
+        if not file:
+            raise ValueError(f"File with ID {file_id} not found in storage {storage_id}")
+        return _row(file)
+
+
+async def save_file(storage_id: int, filename: str, local_path: str, file_type: str, source: str = None,
+                    description: str = None):
+    async with db_connection() as conn:
+        async with conn.transaction():
+            if not await conn.fetchval("SELECT id FROM storages WHERE id = $1", storage_id):
+                raise ValueError(f"Storage with ID {storage_id} not found")
+
+            file = await conn.fetchrow(
+                """
+                INSERT INTO files (name, local_path, type, source)
+                VALUES ($1, $2, $3, $4)
+                RETURNING *
+                """,
+                filename, local_path, file_type, source
+            )
+            file_id = file['id']
+
+            await conn.execute(
+                "INSERT INTO storage_files (storage_id, file_id) VALUES ($1, $2)", storage_id, file_id
+            )
+
+            if description:
+                await conn.execute(
+                    "INSERT INTO file_metadata (file_id, metadata) VALUES ($1, $2::jsonb)",
+                    file_id, {"description": description}
+                )
+        return _row(file)
+
+
+async def get_storage_by_id(storage_id: int):
+    try:
+        async with db_connection() as conn:
+            storage = await conn.fetchrow("SELECT * FROM storages WHERE id = $1", storage_id)
+    except Exception as e:
+        logger.error(f"Ошибка при получении хранилища: {e}")
+        raise ValueError(f"Ошибка при получении хранилища: {str(e)}")
+    if not storage:
+        logger.error(f"Storage with ID {storage_id} not found")
+        raise ValueError(f"Ошибка при получении хранилища: Хранилище с ID {storage_id} не найдено")
+    return dict(storage)
+
+
+async def add_url_to_storage_collection(storage_id: int, url: str):
+    try:
+        async with db_connection() as conn:
+            async with conn.transaction():
+                logger.info(f"Checking storage with ID: {storage_id}")
+                if not await conn.fetchrow("SELECT * FROM storages WHERE id = $1", storage_id):
+                    logger.error(f"Storage with ID {storage_id} not found")
+                    raise ValueError(f"Хранилище с ID {storage_id} не найдено")
+
+                logger.info(f"Adding URL: {url} to storage")
+                file_info = await conn.fetchrow(
+                    """
+                    INSERT INTO files
+                    (name, local_path, type, source, storage_id)
+                    VALUES ($1, $2, $3, $4, $5)
+                    RETURNING id, name, local_path, type, source, storage_id, created_at, updated_at
+                    """,
+                    url, url, 'link', 'url', storage_id
+                )
+        serialized_file_info = _row(file_info)
+        logger.info(f"Successfully added URL file with ID: {serialized_file_info['id']}")
+        return serialized_file_info
+    except Exception as e:
+        logger.error(f"Error in add_url_to_storage_collection: {e}")
+        raise ValueError(f"Не удалось добавить URL: {str(e)}")
+
+
+async def delete_storage_file(storage_id: int, file_id: int):
+    async with db_connection() as conn:
+        async with conn.transaction():
+            file = await conn.fetchrow(
+                """
+                SELECT f.id, f.local_path
+                FROM files f
+                JOIN storage_files sf ON f.id = sf.file_id
+                WHERE sf.storage_id = $1 AND f.id = $2
+                """,
+                storage_id, file_id
+            )
+            if not file:
+                raise ValueError(f"File with ID {file_id} not found in storage {storage_id}")
+
+            await conn.execute(
+                "DELETE FROM storage_files WHERE storage_id = $1 AND file_id = $2", storage_id, file_id
+            )
+            await conn.execute("DELETE FROM files WHERE id = $1", file_id)
+        # Return local path for physical file deletion
+        return file['local_path']
+
+
+async def update_file_info(storage_id: int, file_id: int, metadata: dict):
+    async with db_connection() as conn:
+        async with conn.transaction():
+            exists = await conn.fetchval(
+                """
+                SELECT f.id
+                FROM files f
+                JOIN storage_files sf ON f.id = sf.file_id
+                WHERE sf.storage_id = $1 AND f.id = $2
+                """,
+                storage_id, file_id
+            )
+            if not exists:
+                raise ValueError(f"File with ID {file_id} not found in storage {storage_id}")
+
+            if "name" in metadata:
+                await conn.execute(
+                    "UPDATE files SET name = $1, updated_at = NOW() WHERE id = $2", metadata["name"], file_id
+                )
+
+            await conn.execute(
+                """
+                INSERT INTO file_metadata (file_id, metadata)
+                VALUES ($1, $2::jsonb)
+                ON CONFLICT (file_id) DO UPDATE
+                SET metadata = file_metadata.metadata || EXCLUDED.metadata,
+                    updated_at = NOW()
+                """,
+                file_id, metadata
+            )
+
+            file = await conn.fetchrow(
+                """
+                SELECT f.*, m.metadata
+                FROM files f
+                LEFT JOIN file_metadata m ON f.id = m.file_id
+                WHERE f.id = $1
+                """,
+                file_id
+            )
+        return _row(file)
+
+
+async def enqueue_ingest_job(source: str, collection_name: str, storage_id: int = None):
+    async with db_connection() as conn:
+        job = await conn.fetchrow(
+            """
+            INSERT INTO ingest_jobs (source, collection_name, storage_id)
+            VALUES ($1, $2, $3)
+            RETURNING *
+            """,
+            source, collection_name, storage_id
+        )
+        return _row(job)
+
+
+async def claim_ingest_job():
+    """Взять следующую задачу из очереди. SKIP LOCKED позволяет нескольким воркерам не мешать друг другу"""
+    async with db_connection() as conn:
+        job = await conn.fetchrow(
+            """
+            UPDATE ingest_jobs
+            SET status = 'running', stage = NULL, stages = '{}'::jsonb, error = NULL,
+                attempts = attempts + 1, started_at = NOW(), heartbeat_at = NOW(), updated_at = NOW()
+            WHERE id = (
+                SELECT id FROM ingest_jobs
+                WHERE status = 'queued'
+                ORDER BY id
+                FOR UPDATE SKIP LOCKED
+                LIMIT 1
+            )
+            RETURNING *
+            """
+        )
+        return _row(job)
+
+
+async def update_ingest_job_stage(job_id: int, stage: str, seconds: float = None):
+    async with db_connection() as conn:
+        if seconds is None:
+            await conn.execute(
+                "UPDATE ingest_jobs SET stage = $1, updated_at = NOW() WHERE id = $2", stage, job_id
+            )
+        else:
+            await conn.execute(
+                """
+                UPDATE ingest_jobs
+                SET stage = $1, stages = stages || jsonb_build_object($1::text, $2::float8), updated_at = NOW()
+                WHERE id = $3
+                """,
+                stage, seconds, job_id
+            )
+
+
+async def finish_ingest_job(job_id: int, chunks: int = None, error: str = None):
+    async with db_connection() as conn:
+        await conn.execute(
+            """
+            UPDATE ingest_jobs
+            SET status = $1, chunks = $2, error = $3, finished_at = NOW(), updated_at = NOW()
+            WHERE id = $4
+            """,
+            'failed' if error else 'done', chunks, error, job_id
+        )
+
+
+async def heartbeat_ingest_jobs(job_ids: list):
+    """Отметка, что задачи ещё выполняются этим экземпляром сервиса"""
+    async with db_connection() as conn:
+        await conn.execute(
+            "UPDATE ingest_jobs SET heartbeat_at = NOW() WHERE id = ANY($1::int[]) AND status = 'running'",
+            list(job_ids)
+        )
+
+
+async def requeue_stale_ingest_jobs(timeout: float):
+    """
+    Задачи, у которых heartbeat не обновлялся timeout секунд (экземпляр упал или перезапущен),
+    возвращаются в очередь. Задачи живых экземпляров не трогаются
+    """
+    async with db_connection() as conn:
+        result = await conn.execute(
+            """
+            UPDATE ingest_jobs SET status = 'queued', updated_at = NOW()
+            WHERE status = 'running'
+              AND COALESCE(heartbeat_at, started_at, updated_at) < NOW() - $1 * INTERVAL '1 second'
+            """,
+            float(timeout)
+        )
+        return int(result.split()[-1])
+
+
+async def get_ingest_job(job_id: int):
+    async with db_connection() as conn:
+        job = await conn.fetchrow("SELECT * FROM ingest_jobs WHERE id = $1", job_id)
+        if not job:
+            raise ValueError(f"Ingest job with ID {job_id} not found")
+        return _row(job)
@@ -0,0 +1,264 @@
+"""
+In-process BM25 индекс по текстам чанков, по одному на коллекцию.
+Обновляется при индексации и сохраняется на диск рядом с остальными данными
+"""
+import os
+import re
+import math
+import fcntl
+import pickle
+import logging
+import threading
+from contextlib import contextmanager
+from collections import Counter, defaultdict
+
+logger = logging.getLogger(__name__)
+
+BM25_DIR = os.getenv("BM25_DIR", os.path.join("data", "bm25"))
+# Журнал операций переписывается в снимок, когда становится больше этой доли снимка (и больше минимума)
+BM25_LOG_COMPACT_RATIO = float(os.getenv("BM25_LOG_COMPACT_RATIO", "0.5"))
+BM25_LOG_COMPACT_MIN_BYTES = int(os.getenv("BM25_LOG_COMPACT_MIN_BYTES", str(16 * 1024 ** 2)))
+
+# Слова, а также коды вида "12.3", "A-17", "3/4" целиком
+TOKEN_RE = re.compile(r"\w+(?:[-./]\w+)*")
+
+
+def tokenize(text: str) -> list:
+    return TOKEN_RE.findall(text.lower())
+
+
+class BM25Index:
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings = defaultdict(dict)  # term -> {id чанка: tf}
+        self.lengths = {}  # id чанка -> длина в токенах
+        self.documents = {}  # id чанка -> (текст, метаданные)
+        self.total_length = 0
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def add(self, ids: list, texts: list, metadatas: list = None):
+        """Добавляет или заменяет чанки"""
+        self.remove([id_ for id_ in ids if id_ in self.lengths])
+        metadatas = metadatas or [None] * len(ids)
+        for id_, text, metadata in zip(ids, texts, metadatas):
+            terms = Counter(tokenize(text))
+            for term, tf in terms.items():
+                self.postings[term][id_] = tf
+            length = sum(terms.values())
+            self.lengths[id_] = length
+            self.total_length += length
+            self.documents[id_] = (text, metadata)
+
+    def remove(self, ids: list):
+        for id_ in ids:
+            if id_ not in self.lengths:
+                continue
+            text, _ = self.documents.pop(id_)
+            for term in set(tokenize(text)):
+                term_postings = self.postings.get(term)
+                if term_postings is not None:
+                    term_postings.pop(id_, None)
+                    if not term_postings:
+                        del self.postings[term]
+            self.total_length -= self.lengths.pop(id_)
+
+    def search(self, query: str, k: int = 10) -> list:
+        """
+        Returns:
+            list: Пары (id чанка, score) по убыванию score
+        """
+        n = len(self.lengths)
+        if not n:
+            return []
+        avg_length = self.total_length / n
+        scores = defaultdict(float)
+        for term in set(tokenize(query)):
+            term_postings = self.postings.get(term)
+            if not term_postings:
+                continue
+            idf = math.log(1 + (n - len(term_postings) + 0.5) / (len(term_postings) + 0.5))
+            for id_, tf in term_postings.items():
+                norm = self.k1 * (1 - self.b + self.b * self.lengths[id_] / avg_length)
+                scores[id_] += idf * tf * (self.k1 + 1) / (tf + norm)
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+
+
+class BM25Registry:
+    """
+    Индексы по коллекциям. Индекс загружается с диска при первом обращении и перечитывается,
+    если файлы обновил другой процесс (например bulk_ingest).
+
+    На диске индекс - снимок {имя}.pkl и журнал операций {имя}.log после него. Сохранение дописывает
+    в журнал только новые операции, так что его цена зависит от размера изменений, а не коллекции.
+    Когда журнал перерастает BM25_LOG_COMPACT_RATIO от снимка, снимок переписывается, журнал обнуляется.
+    Всё чтение и запись файлов идёт под flock на {имя}.lock: если файлы успел обновить другой процесс,
+    индекс перечитывается и свои несохранённые операции применяются к нему заново
+    """
+
+    def __init__(self, directory: str = BM25_DIR):
+        self.directory = directory
+        self._indexes = {}  # имя коллекции -> (индекс, версия файлов)
+        self._pending = defaultdict(list)  # имя коллекции -> операции после последней записи на диск
+        self._locks = defaultdict(threading.Lock)
+        self._lock = threading.Lock()
+
+    def _path(self, collection_name: str) -> str:
+        return os.path.join(self.directory, f"{collection_name}.pkl")
+
+    def _log_path(self, collection_name: str) -> str:
+        return os.path.join(self.directory, f"{collection_name}.log")
+
+    def _lock_for(self, collection_name: str):
+        with self._lock:
+            return self._locks[collection_name]
+
+    @contextmanager
+    def _file_lock(self, collection_name: str):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, f"{collection_name}.lock"), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _version(self, collection_name: str):
+        """
+        Снимок заменяется через os.replace (меняются inode и mtime), журнал только растёт или обнуляется
+        вместе с заменой снимка. None, если снимка ещё нет
+        """
+        try:
+            stat = os.stat(self._path(collection_name))
+        except FileNotFoundError:
+            return None
+        log_path = self._log_path(collection_name)
+        log_size = os.path.getsize(log_path) if os.path.exists(log_path) else 0
+        return stat.st_ino, stat.st_mtime_ns, log_size
+
+    @staticmethod
+    def _apply(index: BM25Index, operations):
+        for removed, ids, texts, metadatas in operations:
+            index.remove(removed)
+            index.add(ids, texts, metadatas)
+
+    def _read_log(self, collection_name: str):
+        log_path = self._log_path(collection_name)
+        if not os.path.exists(log_path):
+            return
+        with open(log_path, 'rb') as f:
+            while True:
+                try:
+                    yield pickle.load(f)
+                except EOFError:
+                    return
+
+    def _load(self, collection_name: str) -> BM25Index:
+        """Снимок, журнал и ещё не записанные операции этого процесса. Вызывается под _file_lock"""
+        with open(self._path(collection_name), 'rb') as f:
+            index = pickle.load(f)
+        self._apply(index, self._read_log(collection_name))
+        self._apply(index, self._pending[collection_name])
+        return index
+
+    def get(self, collection_name: str, collection=None) -> BM25Index:
+        """
+        Args:
+            collection (optional): Коллекция векторного хранилища, из которой строится индекс, если его ещё нет на диске
+        """
+        with self._lock_for(collection_name):
+            version = self._version(collection_name)
+            cached = self._indexes.get(collection_name)
+            if cached is not None and (version is None or cached[1] == version):
+                return cached[0]
+
+            if version is None and collection is None:
+                index = BM25Index()
+            else:
+                with self._file_lock(collection_name):
+                    # Пока ждали блокировку, файлы мог записать или индекс построить другой процесс
+                    version = self._version(collection_name)
+                    if version is not None:
+                        index = self._load(collection_name)
+                    else:
+                        index = BM25Index()
+                        stored = collection.get(include=["documents", "metadatas"])
+                        index.add(stored['ids'], stored['documents'], stored['metadatas'])
+                        logger.info(f"Built BM25 index for {collection_name} from {len(index)} stored chunks")
+                        version = self._write(collection_name, index)
+            self._indexes[collection_name] = (index, version)
+            return index
+
+    def update(self, collection_name: str, collection=None, ids: list = (), texts: list = (),
+               metadatas: list = None, removed: list = (), save: bool = True):
+        """
+        Добавляет/заменяет и удаляет чанки в индексе коллекции.
+
+        Args:
+            save (bool): Сразу записать индекс на диск. При массовой загрузке лучше сохранить один раз в конце
+        """
+        index = self.get(collection_name, collection)
+        operation = (list(removed), list(ids), list(texts), list(metadatas) if metadatas else None)
+        with self._lock_for(collection_name):
+            index.remove(operation[0])
+            index.add(*operation[1:])
+            self._pending[collection_name].append(operation)
+        if save:
+            self.save(collection_name)
+
+    def search(self, collection_name: str, query: str, k: int = 10, collection=None):
+        """
+        Returns:
+            list: Кортежи (id чанка, score, текст, метаданные) по убыванию score
+        """
+        index = self.get(collection_name, collection)
+        # Под тем же локом, что и обновления: словари индекса нельзя обходить во время изменения
+        with self._lock_for(collection_name):
+            return [(id_, score, *index.documents[id_]) for id_, score in index.search(query, k)]
+
+    def save(self, collection_name: str):
+        with self._lock_for(collection_name):
+            cached = self._indexes.get(collection_name)
+            pending = self._pending[collection_name]
+            if cached is None or not pending:
+                return
+            with self._file_lock(collection_name):
+                index, version = cached
+                disk_version = self._version(collection_name)
+                if disk_version is not None and disk_version != version:
+                    # Файлы записал другой процесс: его изменения плюс свои операции поверх
+                    index = self._load(collection_name)
+                if disk_version is None or self._log_too_large(collection_name):
+                    version = self._write(collection_name, index)
+                else:
+                    with open(self._log_path(collection_name), 'ab') as f:
+                        for operation in pending:
+                            pickle.dump(operation, f, protocol=pickle.HIGHEST_PROTOCOL)
+                    version = self._version(collection_name)
+                self._indexes[collection_name] = (index, version)
+                pending.clear()
+
+    def _log_too_large(self, collection_name: str) -> bool:
+        log_path = self._log_path(collection_name)
+        if not os.path.exists(log_path):
+            return False
+        limit = max(BM25_LOG_COMPACT_MIN_BYTES, BM25_LOG_COMPACT_RATIO * os.path.getsize(self._path(collection_name)))
+        return os.path.getsize(log_path) > limit
+
+    def _write(self, collection_name: str, index: BM25Index):
+        """
+        Полный снимок и пустой журнал. Вызывается под _file_lock. Если процесс упадёт между заменой снимка
+        и обнулением журнала, журнал применится к снимку повторно - операции идемпотентны
+        """
+        path = self._path(collection_name)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+        open(self._log_path(collection_name), 'wb').close()
+        return self._version(collection_name)
+
+
+bm25_indexes = BM25Registry()
@@ -0,0 +1,322 @@
+"""
+Массовая индексация источников конвейером из стадий:
+fetch (потоки) -> parse (процессы: HTML -> markdown, разбор PDF) -> embed (батчи окон) -> insert (батчи в векторное хранилище).
+Между стадиями ограниченные очереди, так что сеть, разбор, модель и запись идут одновременно.
+
+    python bulk_ingest.py sources.txt --collection test
+    cat sources.txt | python bulk_ingest.py - --collection test
+"""
+import os
+import sys
+import time
+import queue
+import argparse
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import numpy as np
+
+from utils import fetch_url, html2markdown, convert_fetched
+from pdf_extract import extract_pdf_pages, process_context
+from late_chunking import process_many_texts, process_page_stream, EMBED_BATCH_TOKENS
+from add_data import source_chunk_records, delete_stale_chunks
+from collection_registry import collection_registry, collection_versions
+from bm25 import bm25_indexes
+from embedding_cache import embedding_cache
+
+_DONE = object()
+
+
+class StageStats:
+    def __init__(self, name: str):
+        self.name = name
+        self.items = 0
+        self.busy = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, items: int, seconds: float):
+        with self._lock:
+            self.items += items
+            self.busy += seconds
+
+    def line(self, elapsed: float):
+        rate = self.items / elapsed if elapsed else 0.0
+        return f"{self.name}: {self.items} ({rate:.1f}/s, busy {self.busy:.1f}s)"
+
+
+def read_sources(path: str):
+    stream = sys.stdin if path == "-" else open(path, encoding="utf-8")
+    try:
+        return [line.strip() for line in stream if line.strip() and not line.strip().startswith("#")]
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+
+
+class BulkIngest:
+    def __init__(self, collection_name: str, fetch_workers: int = 8, parse_workers: int = 2,
+                 queue_size: int = 16, embed_docs: int = 8, insert_batch: int = 512,
+                 max_batch_tokens: int = EMBED_BATCH_TOKENS, report_every: float = 5.0):
+        self.collection_name = collection_name
+        self.collection = collection_registry.get(collection_name)
+        self.fetch_workers = fetch_workers
+        self.parse_workers = parse_workers
+        self.embed_docs = embed_docs
+        self.insert_batch = insert_batch
+        self.max_batch_tokens = max_batch_tokens
+        self.report_every = report_every
+
+        self.fetched = queue.Queue(maxsize=queue_size)
+        self.parsed = queue.Queue(maxsize=queue_size)
+        self.embedded = queue.Queue(maxsize=queue_size)
+        self.stats = {name: StageStats(name) for name in ("fetch", "parse", "embed", "insert")}
+        self.errors = []
+        self._finished = threading.Event()
+
+    def run(self, sources: list):
+        started = time.monotonic()
+        threads = [
+            threading.Thread(target=self._fetch_stage, args=(sources,), name="fetch"),
+            threading.Thread(target=self._parse_stage, name="parse"),
+            threading.Thread(target=self._embed_stage, name="embed"),
+            threading.Thread(target=self._insert_stage, name="insert"),
+        ]
+        monitor = threading.Thread(target=self._monitor, args=(started,), name="monitor", daemon=True)
+        for thread in threads:
+            thread.start()
+        monitor.start()
+        for thread in threads:
+            thread.join()
+        self._finished.set()
+
+        self._report(started)
+        cache = embedding_cache.stats()
+        print(
+            f"embedding cache: hit rate {cache['hit_rate']:.1%} ({cache['hits']} hits, {cache['misses']} misses), "
+            f"{cache['bytes_saved'] / 1024 ** 2:.1f} MB of embeddings reused, "
+            f"{cache['entries']} windows / {cache['bytes'] / 1024 ** 2:.1f} MB stored"
+        )
+        for source, error in self.errors:
+            print(f"FAILED {source}: {error}")
+
+    def _fetch_one(self, source: str):
+        started = time.monotonic()
+        try:
+            if source.startswith("http"):
+                # Разбор HTML - CPU работа, она идёт в процессах стадии parse
+                result = fetch_url(source, convert=False)
+                item = (source, "url", result) if result.text is None else (source, "text", result.text)
+            elif source.endswith(".pdf"):
+                item = (source, "pdf", source)
+            else:
+                raise ValueError("Не поддерживаемый формат")
+        except Exception as e:
+            self.errors.append((source, str(e)))
+            return
+        self.stats["fetch"].record(1, time.monotonic() - started)
+        self.fetched.put(item)
+
+    def _fetch_stage(self, sources: list):
+        try:
+            with ThreadPoolExecutor(max_workers=self.fetch_workers, thread_name_prefix="fetch") as executor:
+                list(executor.map(self._fetch_one, sources))
+        finally:
+            self.fetched.put(_DONE)
+
+    def _parse_stage(self):
+        # HTML страниц и PDF разбираются в отдельных процессах, текст из crawl_cache (304) уже готов
+        pending = []
+        done = False
+        try:
+            with ProcessPoolExecutor(max_workers=self.parse_workers, mp_context=process_context()) as executor:
+                while True:
+                    item = self.fetched.get()
+                    if item is _DONE:
+                        done = True
+                        break
+                    source, kind, payload = item
+                    if kind == "url":
+                        future = executor.submit(html2markdown, payload.html)
+                        pending.append((source, kind, payload, time.monotonic(), future))
+                    elif kind == "pdf":
+                        future = executor.submit(extract_pdf_pages, payload)
+                        pending.append((source, kind, payload, time.monotonic(), future))
+                    else:
+                        self.stats["parse"].record(1, 0.0)
+                        self.parsed.put((source, "url", [(None, payload)]))
+                    pending = self._drain_parsed(pending, block=len(pending) >= self.parse_workers * 2)
+                self._drain_parsed(pending, block=True)
+        finally:
+            if not done:
+                self._drain(self.fetched)
+            self.parsed.put(_DONE)
+
+    def _drain_parsed(self, pending: list, block: bool):
+        left = []
+        for source, kind, payload, started, future in pending:
+            if not block and not future.done():
+                left.append((source, kind, payload, started, future))
+                continue
+            try:
+                if kind == "url":
+                    text = convert_fetched(payload, future.result()).text
+                    pages = [(None, text)]
+                else:
+                    pages = future.result()
+            except Exception as e:
+                self.errors.append((source, str(e)))
+                continue
+            self.stats["parse"].record(1, time.monotonic() - started)
+            self.parsed.put((source, kind, pages))
+        return left
+
+    def _embed_stage(self):
+        done = False
+        try:
+            while not done:
+                # Берём сразу несколько документов, чтобы их окна попали в общие батчи
+                docs = [self.parsed.get()]
+                while len(docs) < self.embed_docs and not self.parsed.empty():
+                    docs.append(self.parsed.get())
+                if docs[-1] is _DONE:
+                    docs.pop()
+                    done = True
+                if not docs:
+                    continue
+
+                started = time.monotonic()
+                try:
+                    self._embed_docs(docs, datetime.now().isoformat())
+                except Exception as e:
+                    # Ошибки отдельных документов ловятся внутри, сюда попадает только что-то неожиданное
+                    self.errors.extend((doc[0], str(e)) for doc in docs)
+                self.stats["embed"].record(len(docs), time.monotonic() - started)
+        finally:
+            if not done:
+                self._drain(self.parsed)
+            self.embedded.put(_DONE)
+
+    def _embed_docs(self, docs: list, created_at: str):
+        self._embed_urls([doc for doc in docs if doc[1] == "url"], created_at)
+        for source, _, pages in (doc for doc in docs if doc[1] == "pdf"):
+            try:
+                chunks, embeddings, chunk_pages, windows = process_page_stream(iter(pages), self.max_batch_tokens)
+            except Exception as e:
+                self.errors.append((source, str(e)))
+                continue
+            metadata = {"created_at": created_at, "pdf_path": source}
+            metadatas = [{**metadata, 'page': page} for page in chunk_pages]
+            self.embedded.put((source, chunks, embeddings, metadatas, windows))
+
+    def _embed_urls(self, urls: list, created_at: str):
+        """Не бросает исключений: документ, на котором упала модель, попадает в errors"""
+        if not urls:
+            return
+        try:
+            results = process_many_texts([pages[0][1] for _, _, pages in urls], self.max_batch_tokens)
+        except Exception as e:
+            if len(urls) == 1:
+                self.errors.append((urls[0][0], str(e)))
+                return
+            # Общий батч упал - по одному документу, чтобы ошибка досталась только виновнику
+            for url in urls:
+                self._embed_urls([url], created_at)
+            return
+        for (source, _, _), (chunks, embeddings, windows) in zip(urls, results):
+            metadata = {"created_at": created_at, "url": source}
+            self.embedded.put((source, chunks, embeddings, [metadata for _ in chunks], windows))
+
+    @staticmethod
+    def _drain(source_queue: queue.Queue):
+        """Стадия упала: дочитать очередь до _DONE, чтобы предыдущие стадии не зависли на put"""
+        while source_queue.get() is not _DONE:
+            pass
+
+    def _insert_stage(self):
+        # Источники копятся до insert_batch чанков, затем записываются одним upsert
+        batch = []
+        batch_chunks = 0
+
+        def flush():
+            if not batch:
+                return
+            started = time.monotonic()
+            ids, documents, embeddings, metadatas = [], [], [], []
+            try:
+                for source, chunks, chunk_embeddings, chunk_metadatas, windows in batch:
+                    chunk_ids, chunk_metadatas = source_chunk_records(source, chunks, chunk_metadatas, windows)
+                    ids.extend(chunk_ids)
+                    documents.extend(chunks)
+                    embeddings.append(chunk_embeddings)
+                    metadatas.extend(chunk_metadatas)
+                if ids:
+                    self.collection.upsert(
+                        documents=documents, embeddings=np.concatenate(embeddings), metadatas=metadatas, ids=ids
+                    )
+                # Удаление устаревших чанков идёт после записи, чтобы источник не пропадал из поиска
+                removed = []
+                for source, *_ in batch:
+                    removed.extend(delete_stale_chunks(self.collection, source, ids))
+                bm25_indexes.update(
+                    self.collection_name, self.collection, ids, documents, metadatas, removed=removed, save=False
+                )
+                collection_versions.bump(self.collection_name)
+                self.stats["insert"].record(batch_chunks, time.monotonic() - started)
+            except Exception as e:
+                for source, *_ in batch:
+                    self.errors.append((source, str(e)))
+            finally:
+                batch.clear()
+
+        done = False
+        try:
+            while True:
+                item = self.embedded.get()
+                if item is _DONE:
+                    done = True
+                    break
+                batch.append(item)
+                batch_chunks += len(item[1])
+                if batch_chunks >= self.insert_batch:
+                    flush()
+                    batch_chunks = 0
+            flush()
+            bm25_indexes.save(self.collection_name)
+        finally:
+            if not done:
+                self._drain(self.embedded)
+
+    def _monitor(self, started: float):
+        while not self._finished.wait(self.report_every):
+            self._report(started)
+
+    def _report(self, started: float):
+        elapsed = time.monotonic() - started
+        stages = " | ".join(stats.line(elapsed) for stats in self.stats.values())
+        depths = f"queues fetched={self.fetched.qsize()} parsed={self.parsed.qsize()} embedded={self.embedded.qsize()}"
+        print(f"[{elapsed:7.1f}s] {stages} | {depths}", flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk ingestion of URLs and PDFs into a vector store collection")
+    parser.add_argument("sources", help="File with one URL or PDF path per line, '-' for stdin")
+    parser.add_argument("--collection", default="test")
+    parser.add_argument("--fetch-workers", type=int, default=8)
+    parser.add_argument("--parse-workers", type=int, default=min(4, os.cpu_count() or 1))
+    parser.add_argument("--queue-size", type=int, default=16)
+    parser.add_argument("--embed-docs", type=int, default=8, help="Documents per embedding round")
+    parser.add_argument("--insert-batch", type=int, default=512, help="Chunks per vector store upsert")
+    parser.add_argument("--max-batch-tokens", type=int, default=EMBED_BATCH_TOKENS)
+    parser.add_argument("--report-every", type=float, default=5.0, help="Seconds between progress lines")
+    args = parser.parse_args()
+
+    BulkIngest(
+        args.collection, fetch_workers=args.fetch_workers, parse_workers=args.parse_workers,
+        queue_size=args.queue_size, embed_docs=args.embed_docs, insert_batch=args.insert_batch,
+        max_batch_tokens=args.max_batch_tokens, report_every=args.report_every
+    ).run(read_sources(args.sources))
+
+
+if __name__ == '__main__':
+    main()
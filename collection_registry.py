@@ -0,0 +1,153 @@
+import os
+import sqlite3
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+# chroma - HTTP сервер Chroma, local - встроенное хранилище из vector_store.py
+VECTOR_STORE = os.getenv("VECTOR_STORE", "chroma")
+
+
+def create_vector_client(backend: str = VECTOR_STORE):
+    """
+    Клиент векторного хранилища. Любой бэкенд отдаёт коллекции с API коллекций Chroma:
+    upsert / get / query / delete / count / modify
+    """
+    if backend == "local":
+        from vector_store import LocalVectorStore
+        return LocalVectorStore()
+    if backend == "chroma":
+        # Disable ChromaDB telemetry
+        os.environ['ANONYMIZED_TELEMETRY'] = 'False'
+        import chromadb
+        return chromadb.HttpClient(
+            host=os.getenv("CHROMA_HOST", "localhost"), port=int(os.getenv("CHROMA_PORT", "8027"))
+        )
+    raise ValueError(f"Unknown VECTOR_STORE backend: {backend}")
+
+
+def collection_not_found_errors(backend: str = VECTOR_STORE) -> tuple:
+    """Исключения клиента, означающие, что коллекции нет"""
+    if backend == "local":
+        from vector_store import CollectionNotFoundError
+        return (CollectionNotFoundError,)
+    import chromadb.errors
+    names = ("NotFoundError", "InvalidCollectionException")
+    return tuple(getattr(chromadb.errors, name) for name in names if hasattr(chromadb.errors, name))
+
+
+vector_client = create_vector_client()
+
+
+class CollectionRegistry:
+    """
+    Кэш хэндлов коллекций векторного хранилища по имени (storage_collection_name).
+    Убирает get_or_create_collection на каждый запрос, сбрасывается при удалении и переименовании.
+    Запись создаёт коллекцию при первом обращении, поиск (create=False) - нет
+    """
+
+    def __init__(self, client, not_found_errors: tuple = ()):
+        self.client = client
+        self.not_found_errors = not_found_errors
+        self._collections = {}
+        self._lock = threading.Lock()
+
+    def get(self, name: str, create: bool = True):
+        collection = self._collections.get(name)
+        if collection is None:
+            with self._lock:
+                collection = self._collections.get(name)
+                if collection is None:
+                    if create:
+                        collection = self.client.get_or_create_collection(name=name)
+                    else:
+                        collection = self.client.get_collection(name=name)
+                    self._collections[name] = collection
+        return collection
+
+    def is_missing(self, error: Exception) -> bool:
+        """Ошибка клиента о том, что коллекции нет. Остальные ошибки не превращаются в пустой результат"""
+        if isinstance(error, self.not_found_errors):
+            return True
+        # Старые версии Chroma отдают голый ValueError
+        return type(error) is ValueError and "does not exist" in str(error)
+
+    def invalidate(self, name: str = None):
+        with self._lock:
+            if name is None:
+                self._collections.clear()
+            else:
+                self._collections.pop(name, None)
+
+    def delete(self, name: str):
+        self.invalidate(name)
+        self.client.delete_collection(name=name)
+
+    def rename(self, name: str, new_name: str):
+        self.get(name).modify(name=new_name)
+        self.invalidate(name)
+        self.invalidate(new_name)
+
+    def call(self, name: str, func, create: bool = True):
+        """
+        Выполнить func(collection). Если коллекцию удалили снаружи и хэндл устарел,
+        хэндл сбрасывается и вызов повторяется один раз
+        """
+        try:
+            return func(self.get(name, create))
+        except Exception as e:
+            if not self.is_missing(e):
+                raise
+            logger.info(f"Collection handle for {name} is stale, reloading")
+            self.invalidate(name)
+            return func(self.get(name, create))
+
+
+collection_registry = CollectionRegistry(vector_client, collection_not_found_errors())
+
+COLLECTION_VERSIONS_PATH = os.getenv("COLLECTION_VERSIONS_PATH", os.path.join("data", "collection_versions.sqlite"))
+
+
+class CollectionVersions:
+    """
+    Номер версии коллекции, растёт при каждой записи в неё.
+    Лежит в SQLite, чтобы запись из bulk_ingest была видна сервису
+    """
+
+    def __init__(self, path: str = COLLECTION_VERSIONS_PATH):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS collection_versions (name TEXT PRIMARY KEY, version INTEGER NOT NULL)"
+        )
+        self._conn.commit()
+
+    def get(self, name: str) -> int:
+        with self._lock:
+            row = self._conn.execute("SELECT version FROM collection_versions WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else 0
+
+    def bump(self, name: str):
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO collection_versions (name, version) VALUES (?, 1) "
+                "ON CONFLICT (name) DO UPDATE SET version = version + 1",
+                (name,)
+            )
+            self._conn.commit()
+
+
+collection_versions = CollectionVersions()
+
+
+def storage_collection_name(storage: dict) -> str:
+    """
+    Коллекция хранилища называется по его id: nickname может содержать кириллицу,
+    а Chroma принимает только [a-zA-Z0-9._-]
+    """
+    return f"storage-{storage['id']}"
@@ -0,0 +1,100 @@
+"""
+Сборка промпта под окно контекста модели: найденные чанки и история чата укладываются в бюджет
+models.context_window за вычетом резерва на ответ. Менее ценное (дальние по релевантности чанки,
+старые сообщения) обрезается или отбрасывается первым
+"""
+import os
+from dataclasses import dataclass, field
+
+from late_chunking import tokenizer
+
+# Окно, если модель чата не найдена
+DEFAULT_CONTEXT_WINDOW = int(os.getenv("DEFAULT_CONTEXT_WINDOW", "8192"))
+# Резерв под ответ, но не больше четверти окна
+ANSWER_TOKENS = int(os.getenv("ANSWER_TOKENS", "1024"))
+# Токены считаются токенизатором эмбеддингов, у LLM свой, поэтому бюджет берётся с запасом
+PROMPT_TOKEN_MARGIN = float(os.getenv("PROMPT_TOKEN_MARGIN", "1.1"))
+# Служебные токены на одно сообщение чата (роль, разделители)
+MESSAGE_OVERHEAD_TOKENS = int(os.getenv("MESSAGE_OVERHEAD_TOKENS", "8"))
+# Обрезанный чанк короче этого не имеет смысла
+MIN_CHUNK_TOKENS = int(os.getenv("MIN_CHUNK_TOKENS", "64"))
+
+CHUNK_SEPARATOR = "\n\n---\n\n"
+
+
+def count_tokens(texts: list) -> list:
+    if not texts:
+        return []
+    return [len(ids) for ids in tokenizer(list(texts), add_special_tokens=False)['input_ids']]
+
+
+def trim_to_tokens(text: str, max_tokens: int) -> str:
+    """Первые max_tokens токенов текста"""
+    offsets = tokenizer(text, add_special_tokens=False, return_offsets_mapping=True)['offset_mapping']
+    if len(offsets) <= max_tokens:
+        return text
+    return text[:offsets[max_tokens - 1][1]]
+
+
+@dataclass
+class PackedContext:
+    chunks: list = field(default_factory=list)
+    history: list = field(default_factory=list)
+    tokens: int = 0
+    budget: int = 0
+    dropped_chunks: int = 0
+    dropped_messages: int = 0
+
+
+def pack_context(fixed_text: str, chunks: list, history: list, context_window: int = None,
+                 answer_tokens: int = ANSWER_TOKENS, history_text=lambda message: message) -> PackedContext:
+    """
+    Args:
+        fixed_text (str): Часть промпта, которая попадает всегда (шаблон с вопросом, без контекста)
+        chunks (list): Тексты чанков от самого релевантного
+        history (list): Сообщения чата в хронологическом порядке
+        context_window (int): models.context_window, по умолчанию DEFAULT_CONTEXT_WINDOW
+        history_text (callable): Текст сообщения истории
+
+    Returns:
+        PackedContext: Оставленные чанки (последний может быть обрезан) и последние сообщения истории
+    """
+    context_window = context_window or DEFAULT_CONTEXT_WINDOW
+    answer_tokens = min(answer_tokens, context_window // 4)
+    fixed_tokens, separator_tokens, *item_tokens = count_tokens(
+        [fixed_text, CHUNK_SEPARATOR] + list(chunks) + [history_text(message) for message in history]
+    )
+    chunk_tokens, message_tokens = item_tokens[:len(chunks)], item_tokens[len(chunks):]
+
+    budget = int((context_window - answer_tokens) / PROMPT_TOKEN_MARGIN) - fixed_tokens
+    packed = PackedContext(budget=budget)
+    left = budget
+    kept_chunks = {}
+    kept_messages = 0
+    history_open = True
+    # Чанки и сообщения берутся поочерёдно по убыванию ценности:
+    # лучший чанк, последнее сообщение, второй чанк, предпоследнее сообщение...
+    for rank in range(max(len(chunks), len(history))):
+        if rank < len(chunks):
+            cost = chunk_tokens[rank] + separator_tokens
+            if cost <= left:
+                kept_chunks[rank] = chunks[rank]
+                left -= cost
+            elif left - separator_tokens >= MIN_CHUNK_TOKENS:
+                kept_chunks[rank] = trim_to_tokens(chunks[rank], left - separator_tokens)
+                left = 0
+        if rank < len(history) and history_open:
+            cost = message_tokens[-1 - rank] + MESSAGE_OVERHEAD_TOKENS
+            if cost <= left:
+                kept_messages += 1
+                left -= cost
+            else:
+                # Более старые сообщения без этого дали бы дыру в истории
+                history_open = False
+
+    packed.chunks = [kept_chunks[rank] for rank in sorted(kept_chunks)]
+    packed.history = history[len(history) - kept_messages:]
+    packed.tokens = fixed_tokens + budget - left
+    packed.dropped_chunks = len(chunks) - len(kept_chunks)
+    packed.dropped_messages = len(history) - kept_messages
+    return packed
@@ -48,3 +48,32 @@ CREATE TABLE chat_history (
     text TEXT NOT NULL,
     FOREIGN KEY (chat_id) REFERENCES chats(id) ON DELETE CASCADE
 );
+
+CREATE TABLE chat_summaries (
+    chat_id INT PRIMARY KEY,
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW() NOT NULL,
+    summary TEXT NOT NULL,
+    last_message_id INT NOT NULL,
+    FOREIGN KEY (chat_id) REFERENCES chats(id) ON DELETE CASCADE
+);
+
+CREATE TABLE ingest_jobs (
+    id SERIAL PRIMARY KEY,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW() NOT NULL,
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW() NOT NULL,
+    source TEXT NOT NULL,
+    collection_name VARCHAR(63) NOT NULL,
+    storage_id INT,
+    status VARCHAR(20) DEFAULT 'queued' NOT NULL CHECK (status IN ('queued', 'running', 'done', 'failed')),
+    stage VARCHAR(50),
+    stages JSONB DEFAULT '{}'::jsonb NOT NULL,
+    chunks INT,
+    error TEXT,
+    attempts INT DEFAULT 0 NOT NULL,
+    started_at TIMESTAMP WITH TIME ZONE,
+    heartbeat_at TIMESTAMP WITH TIME ZONE,
+    finished_at TIMESTAMP WITH TIME ZONE,
+    FOREIGN KEY (storage_id) REFERENCES storages(id) ON DELETE CASCADE
+);
+
+CREATE INDEX ingest_jobs_queued_idx ON ingest_jobs (id) WHERE status = 'queued';
@@ -0,0 +1,142 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+EMBED_CACHE_PATH = os.getenv("EMBED_CACHE_PATH", os.path.join("data", "embedding_cache.sqlite"))
+EMBED_CACHE_MAX_BYTES = int(os.getenv("EMBED_CACHE_MAX_BYTES", str(2 * 1024 ** 3)))
+
+
+def window_key(model_id: str, text_chunks: list) -> str:
+    """Хэш (id модели, текст окна, границы чанков) - адрес эмбеддингов окна в кэше"""
+    h = hashlib.sha256()
+    h.update(model_id.encode('utf-8'))
+    for chunk in text_chunks:
+        data = chunk.encode('utf-8')
+        # Длина перед текстом фиксирует границы чанков
+        h.update(len(data).to_bytes(8, 'little'))
+        h.update(data)
+    return h.hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Content-addressed хранилище эмбеддингов окон в SQLite.
+    При превышении max_bytes вытесняются давно не использованные записи
+    """
+
+    def __init__(self, path: str = EMBED_CACHE_PATH, max_bytes: int = EMBED_CACHE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS window_embeddings (
+                key TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                last_used REAL NOT NULL,
+                n_chunks INTEGER NOT NULL,
+                dim INTEGER NOT NULL,
+                data BLOB NOT NULL
+            )
+            """
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS window_embeddings_last_used ON window_embeddings (last_used)"
+        )
+        # Общий размер записей, обновляется в той же транзакции, что и сами записи
+        self._conn.execute("CREATE TABLE IF NOT EXISTS cache_meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        self._conn.execute(
+            "INSERT OR IGNORE INTO cache_meta (key, value) "
+            "SELECT 'total_bytes', COALESCE(SUM(size), 0) FROM window_embeddings"
+        )
+        self._conn.commit()
+
+    def get(self, key: str):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT n_chunks, dim, data, size FROM window_embeddings WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            n_chunks, dim, data, size = row
+            self._conn.execute("UPDATE window_embeddings SET last_used = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+            self.hits += 1
+            self.bytes_saved += size
+        return np.frombuffer(data, dtype=np.float32).reshape(n_chunks, dim)
+
+    def put(self, key: str, embeddings: np.ndarray):
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        data = embeddings.tobytes()
+        with self._lock:
+            # IMMEDIATE: общий размер читается и меняется атомарно, даже если кэш пишут несколько процессов
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                old = self._conn.execute("SELECT size FROM window_embeddings WHERE key = ?", (key,)).fetchone()
+                self._conn.execute(
+                    """
+                    INSERT OR REPLACE INTO window_embeddings (key, size, last_used, n_chunks, dim, data)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    """,
+                    (key, len(data), time.time(), embeddings.shape[0], embeddings.shape[1], data)
+                )
+                total = self._add_bytes(len(data) - (old[0] if old else 0))
+                if total > self.max_bytes:
+                    self._evict(total)
+                self._conn.commit()
+            except Exception:
+                self._conn.rollback()
+                raise
+
+    def _add_bytes(self, delta: int) -> int:
+        self._conn.execute("UPDATE cache_meta SET value = value + ? WHERE key = 'total_bytes'", (delta,))
+        return self._conn.execute("SELECT value FROM cache_meta WHERE key = 'total_bytes'").fetchone()[0]
+
+    def _evict(self, total: int, batch: int = 256):
+        evicted = 0
+        freed = 0
+        while total - freed > self.max_bytes:
+            rows = self._conn.execute(
+                "SELECT key, size FROM window_embeddings ORDER BY last_used LIMIT ?", (batch,)
+            ).fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                if total - freed <= self.max_bytes:
+                    break
+                self._conn.execute("DELETE FROM window_embeddings WHERE key = ?", (key,))
+                freed += size
+                evicted += 1
+        total = self._add_bytes(-freed)
+        logger.info(f"Embedding cache evicted {evicted} windows, {total} bytes left")
+
+    def stats(self):
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM window_embeddings").fetchone()[0]
+            total = self._conn.execute("SELECT value FROM cache_meta WHERE key = 'total_bytes'").fetchone()[0]
+            lookups = self.hits + self.misses
+            return {
+                "entries": entries, "bytes": total, "max_bytes": self.max_bytes,
+                "hits": self.hits, "misses": self.misses, "hit_rate": self.hits / lookups if lookups else 0.0,
+                "bytes_saved": self.bytes_saved
+            }
+
+
+embedding_cache = EmbeddingCache()
@@ -1,15 +1,23 @@
 import os
-# Disable ChromaDB telemetry
-os.environ['ANONYMIZED_TELEMETRY'] = 'False'
+import time
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
 
-import chromadb
-from late_chunking import embed_model, tokenizer
+import torch
+from late_chunking import embed_model, tokenizer, EMBED_MODEL_ID
+from collection_registry import collection_registry
+from bm25 import bm25_indexes
+from rerank import (
+    filter_and_diversify, reciprocal_rank_fusion, RETRIEVAL_MAX_DISTANCE, RETRIEVAL_FETCH_FACTOR, MMR_LAMBDA
+)
 
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_ollama.llms import OllamaLLM
 
-
-chroma_client = chromadb.HttpClient(host='localhost', port=8027)
+logger = logging.getLogger(__name__)
 
 PROMPT_TEMPLATE = """
 Answer the question based only on the following context:
@@ -22,22 +30,266 @@ model = OllamaLLM(model="hf.co/mav23/Vikhr-Nemo-12B-Instruct-R-21-09-24-GGUF:Q8_
 # model = OllamaLLM(model="llama3.2")
 
 
+class LRUCache:
+    """Потокобезопасный LRU кэш с ограничением на число элементов и счётчиками попаданий"""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._data), "max_size": self.max_size, "hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0
+            }
+
+
+query_embedding_cache = LRUCache(int(os.getenv("QUERY_CACHE_SIZE", "1024")))
+
+
+def normalize_query(query: str) -> str:
+    """Только пробелы: модель различает регистр, поэтому запросы в разном регистре кодируются отдельно"""
+    return " ".join(query.split())
+
+
+@torch.inference_mode()
+def _encode_query(query: str):
+    inputs = tokenizer(query, return_tensors='pt')
+    return embed_model(**inputs).pooler_output[0].cpu().numpy()
+
+
+def encode_query(query: str):
+    """
+    Эмбеддинг запроса. Единственная точка входа для кодирования запросов:
+    инференс без autograd, результат кэшируется по нормализованному тексту и id модели.
+    Кодируется тот же нормализованный текст, что лежит в ключе, поэтому кэш не меняет результат
+    """
+    query = normalize_query(query)
+    key = (EMBED_MODEL_ID, query)
+    embedding = query_embedding_cache.get(key)
+    if embedding is None:
+        embedding = _encode_query(query)
+        embedding.setflags(write=False)
+        query_embedding_cache.put(key, embedding)
+    return embedding
+
+
+# Пул потоков для параллельных запросов к коллекциям (клиенты хранилищ синхронные)
+search_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("SEARCH_WORKERS", "8")), thread_name_prefix="search"
+)
+
+
+def query_collection(collection_name, query_embedding, n_results=3):
+    """Пустой результат, если в коллекцию ещё ничего не загружали: поиск коллекции не создаёт"""
+    try:
+        return collection_registry.call(collection_name, lambda collection: collection.query(
+            query_embeddings=[query_embedding], n_results=n_results,
+            include=["documents", "metadatas", "distances", "embeddings"]
+        ), create=False)
+    except Exception as e:
+        if not collection_registry.is_missing(e):
+            raise
+        return {'ids': [[]], 'documents': [[]], 'metadatas': [[]], 'distances': [[]], 'embeddings': [[]]}
+
+
+# Лексический поиск BM25 вместе с векторным, результаты объединяются через RRF
+HYBRID_SEARCH = os.getenv("HYBRID_SEARCH", "1") == "1"
+
+
+def query_collection_hybrid(collection_name, query, query_embedding, n_results=3):
+    """
+    Векторный запрос к коллекции плюс BM25 по её in-process индексу (поле lexical результата).
+    Для лексических совпадений вне векторного top эмбеддинги догружаются из Chroma, они нужны для MMR
+    """
+    results = query_collection(collection_name, query_embedding, n_results)
+    if not HYBRID_SEARCH or not results['ids'][0]:
+        return results
+    hits = bm25_indexes.search(
+        collection_name, query, n_results, collection_registry.get(collection_name, create=False)
+    )
+    found = set(results['ids'][0])
+    missing = [hit[0] for hit in hits if hit[0] not in found]
+    embeddings = {}
+    if missing:
+        stored = collection_registry.call(
+            collection_name, lambda collection: collection.get(ids=missing, include=["embeddings"]), create=False
+        )
+        embeddings = dict(zip(stored['ids'], stored['embeddings']))
+    # Чанки, которых уже нет в Chroma, отбрасываются
+    results['lexical'] = [
+        (id_, score, document, metadata, embeddings.get(id_)) for id_, score, document, metadata in hits
+        if id_ in found or id_ in embeddings
+    ]
+    return results
+
+
+def merge_results(named_results, n_results=3):
+    """
+    Сливает результаты нескольких коллекций в один глобальный top-k по расстоянию.
+    Если есть лексические совпадения (поле lexical), ранжирование по расстоянию и по BM25
+    объединяется через reciprocal rank fusion. В метаданные каждого чанка добавляется коллекция
+
+    Args:
+        named_results: Пары (имя коллекции, результат collection.query)
+
+    Returns:
+        dict: Результат в формате collection.query с дополнительным полем collections,
+            при гибридном поиске также scores (RRF) и lexical (найден ли чанк BM25)
+    """
+    candidates = {}  # (коллекция, id) -> (расстояние, документ, метаданные, эмбеддинг)
+    lexical_hits = []
+    for collection_name, results in named_results:
+        embeddings = results.get('embeddings')
+        embeddings = embeddings[0] if embeddings is not None else [None] * len(results['ids'][0])
+        for id_, document, metadata, distance, embedding in zip(
+                results['ids'][0], results['documents'][0], results['metadatas'][0], results['distances'][0],
+                embeddings
+        ):
+            metadata = {**(metadata or {}), 'collection': collection_name}
+            candidates[(collection_name, id_)] = (distance, document, metadata, embedding)
+        for id_, score, document, metadata, embedding in results.get('lexical', ()):
+            key = (collection_name, id_)
+            if key not in candidates:
+                candidates[key] = (None, document, {**(metadata or {}), 'collection': collection_name}, embedding)
+            lexical_hits.append((score, key))
+
+    ranking = sorted(
+        (key for key, candidate in candidates.items() if candidate[0] is not None), key=lambda key: candidates[key][0]
+    )
+    scores = None
+    if lexical_hits:
+        lexical_ranking = [key for _, key in sorted(lexical_hits, key=lambda hit: hit[0], reverse=True)]
+        scores = reciprocal_rank_fusion([ranking, lexical_ranking])
+        ranking = sorted(scores, key=scores.get, reverse=True)
+    top = ranking[:n_results]
+    merged = {
+        'ids': [[key[1] for key in top]],
+        'documents': [[candidates[key][1] for key in top]],
+        'metadatas': [[candidates[key][2] for key in top]],
+        'distances': [[candidates[key][0] for key in top]],
+        'collections': [[key[0] for key in top]],
+    }
+    if scores is not None:
+        lexical_keys = {key for _, key in lexical_hits}
+        merged['scores'] = [[scores[key] for key in top]]
+        merged['lexical'] = [[key in lexical_keys for key in top]]
+    if top and all(candidates[key][3] is not None for key in top):
+        merged['embeddings'] = [[candidates[key][3] for key in top]]
+    return merged
+
+
+def _collect(collection_names, outcomes):
+    named_results = []
+    for collection_name, outcome in zip(collection_names, outcomes):
+        if isinstance(outcome, Exception):
+            logger.error(f"Search in collection {collection_name} failed: {outcome}")
+            continue
+        named_results.append((collection_name, outcome))
+    if not named_results:
+        raise outcomes[0]
+    return named_results
+
+
+def search_collections(query, collection_names, n_results=3, max_distance=RETRIEVAL_MAX_DISTANCE,
+                       mmr_lambda=MMR_LAMBDA):
+    """
+    Поиск сразу по нескольким коллекциям: запрос кодируется один раз,
+    коллекции опрашиваются параллельно, задержка ~ самой медленной коллекции.
+    Кандидатов запрашивается с запасом (вектор + BM25), затем они фильтруются по max_distance и прореживаются MMR
+    """
+    query_embedding = encode_query(query)
+    fetch_k = n_results * RETRIEVAL_FETCH_FACTOR
+    futures = [
+        search_executor.submit(query_collection_hybrid, collection_name, query, query_embedding, fetch_k)
+        for collection_name in collection_names
+    ]
+    outcomes = []
+    for future in futures:
+        try:
+            outcomes.append(future.result())
+        except Exception as e:
+            outcomes.append(e)
+    results = merge_results(_collect(collection_names, outcomes), fetch_k)
+    return filter_and_diversify(results, query_embedding, n_results, max_distance, mmr_lambda)
+
+
 def semantic_search(query, collection_name):
-    collection = chroma_client.get_or_create_collection(name="test")
-    embeds = embed_model(**tokenizer(query, return_tensors='pt'))
-    results = collection.query(
-        query_embeddings=embeds.pooler_output.detach().cpu().numpy(), n_results=3
-    )  # другую функцию поиска надо, и подобрать нижнюю границу схожести
+    return search_collections(query, [collection_name])
+
+
+# Отдельный пул потоков для CPU-тяжёлой работы с моделью эмбеддингов, чтобы не занимать event loop
+embed_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("EMBED_WORKERS", "2")), thread_name_prefix="embed"
+)
+
+
+async def run_in_embed_executor(func, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(embed_executor, func, *args)
+
+
+async def asearch_collections(query, collection_names, n_results=3, max_distance=RETRIEVAL_MAX_DISTANCE,
+                              mmr_lambda=MMR_LAMBDA, timings=None):
+    """
+    Args:
+        timings (dict, optional): Сюда записываются длительности этапов embed и search в секундах
+    """
+    loop = asyncio.get_running_loop()
+    started = time.perf_counter()
+    query_embedding = await run_in_embed_executor(encode_query, query)
+    embedded = time.perf_counter()
+    fetch_k = n_results * RETRIEVAL_FETCH_FACTOR
+    outcomes = await asyncio.gather(*[
+        loop.run_in_executor(search_executor, query_collection_hybrid, collection_name, query, query_embedding, fetch_k)
+        for collection_name in collection_names
+    ], return_exceptions=True)
+    results = merge_results(_collect(collection_names, outcomes), fetch_k)
+    results = filter_and_diversify(results, query_embedding, n_results, max_distance, mmr_lambda)
+    if timings is not None:
+        timings['embed'] = embedded - started
+        timings['search'] = time.perf_counter() - embedded
     return results
 
 
-def query_simple_rag(query, collection_name):
-    # Сделать историю / smart context
-    # работа с несколькими коллекциями
+async def asemantic_search(query, collection_name):
+    return await asearch_collections(query, [collection_name])
+
+
+def query_simple_rag(query, collection_names):
+    # Без чата: история и сводка длинных чатов подключаются в стриминговых эндпоинтах app.py (summaries.py)
     # multi hook
-    results = semantic_search(query, collection_name)
+    if isinstance(collection_names, str):
+        collection_names = [collection_names]
+    results = search_collections(query, collection_names)
     context_text = "\n\n---\n\n".join(results['documents'][0])
-    sources = list(set([i['url'] for i in results['metadatas'][0]]))
+    # У чанков из PDF нет url, только source
+    sources = list({i.get('url') or i.get('source') for i in results['metadatas'][0]} - {None})
     prompt = prompt_template.format(context=context_text, question=query)
     response_text = model.predict(prompt)
     return response_text, sources
@@ -0,0 +1,117 @@
+"""
+Фоновая очередь задач индексации (URL, PDF).
+Задачи лежат в таблице ingest_jobs, поэтому переживают перезапуск сервиса.
+Экземпляр сервиса периодически обновляет heartbeat_at своих задач; задачи с устаревшим heartbeat
+(экземпляр упал) любой экземпляр возвращает в очередь
+"""
+import os
+import time
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import async_db
+from add_data import add_into_collection
+from answer_cache import answer_cache
+
+logger = logging.getLogger(__name__)
+
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "2"))
+INGEST_POLL_INTERVAL = float(os.getenv("INGEST_POLL_INTERVAL", "5"))
+INGEST_HEARTBEAT_INTERVAL = float(os.getenv("INGEST_HEARTBEAT_INTERVAL", "30"))
+# Через сколько секунд без heartbeat задача считается брошенной
+INGEST_HEARTBEAT_TIMEOUT = float(os.getenv("INGEST_HEARTBEAT_TIMEOUT", "120"))
+
+
+class IngestionWorkers:
+    """Пул воркеров, разбирающих очередь ingest_jobs с ограниченной параллельностью"""
+
+    def __init__(self, concurrency: int = INGEST_WORKERS, poll_interval: float = INGEST_POLL_INTERVAL,
+                 heartbeat_interval: float = INGEST_HEARTBEAT_INTERVAL,
+                 heartbeat_timeout: float = INGEST_HEARTBEAT_TIMEOUT):
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_timeout = heartbeat_timeout
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="ingest")
+        self._wakeup = asyncio.Event()
+        self._tasks = []
+        self._running = set()  # id задач, которые выполняет этот экземпляр
+
+    async def start(self):
+        """Не требует доступной базы: воркеры и heartbeat повторяют запросы, пока Postgres не поднимется"""
+        self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.concurrency)]
+        self._tasks.append(asyncio.create_task(self._heartbeat()))
+
+    async def _heartbeat(self):
+        while True:
+            try:
+                if self._running:
+                    await async_db.heartbeat_ingest_jobs(self._running)
+                requeued = await async_db.requeue_stale_ingest_jobs(self.heartbeat_timeout)
+                if requeued:
+                    logger.info(f"Requeued {requeued} abandoned ingest jobs")
+                    self._wakeup.set()
+            except Exception as e:
+                logger.error(f"Ingest heartbeat failed: {e}")
+            await asyncio.sleep(self.heartbeat_interval)
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._executor.shutdown(wait=False)
+
+    async def submit(self, source: str, collection_name: str, storage_id: int = None):
+        job = await async_db.enqueue_ingest_job(source, collection_name, storage_id)
+        self._wakeup.set()
+        return job
+
+    async def _worker(self, worker_id: int):
+        while True:
+            try:
+                job = await async_db.claim_ingest_job()
+            except Exception as e:
+                logger.error(f"Ingest worker {worker_id} could not claim job: {e}")
+                job = None
+
+            if job is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            await self._run(job)
+
+    async def _run(self, job):
+        job_id = job['id']
+        loop = asyncio.get_running_loop()
+        logger.info(f"Ingest job {job_id} started: {job['source']}")
+
+        def on_stage(stage, seconds):
+            # Вызывается из потока индексации, запись в базу уходит в event loop
+            asyncio.run_coroutine_threadsafe(async_db.update_ingest_job_stage(job_id, stage, seconds), loop)
+
+        started = time.monotonic()
+        self._running.add(job_id)
+        try:
+            chunks = await loop.run_in_executor(
+                self._executor, add_into_collection, job['source'], job['collection_name'], on_stage
+            )
+        except Exception as e:
+            logger.error(f"Ingest job {job_id} failed: {e}")
+            await async_db.finish_ingest_job(job_id, error=str(e))
+            return
+        finally:
+            self._running.discard(job_id)
+        await async_db.finish_ingest_job(job_id, chunks=chunks)
+        if chunks:
+            # Ответы по коллекции устарели (из bulk_ingest то же самое ловится по версии коллекции)
+            answer_cache.invalidate(job['collection_name'])
+        logger.info(f"Ingest job {job_id} done in {time.monotonic() - started:.1f}s, {chunks} chunks")
+
+
+ingestion_workers = IngestionWorkers()
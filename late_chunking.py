@@ -1,54 +1,326 @@
+import os
+import bisect
+
+import numpy as np
 import torch
 from transformers import AutoTokenizer, AutoModel
 from langchain_text_splitters import TokenTextSplitter
 
+from embedding_cache import embedding_cache, window_key
+
 
-tokenizer = AutoTokenizer.from_pretrained("deepvk/USER-bge-m3")
-embed_model = AutoModel.from_pretrained("deepvk/USER-bge-m3")
+EMBED_MODEL_ID = "deepvk/USER-bge-m3"
+
+tokenizer = AutoTokenizer.from_pretrained(EMBED_MODEL_ID)
+embed_model = AutoModel.from_pretrained(EMBED_MODEL_ID)
 embed_model.eval()
 
+# Размер и перекрытие в токенах: окна (large) и чанки внутри окна (small)
+LARGE_CHUNK_TOKENS, LARGE_CHUNK_OVERLAP = 8000, 128
+SMALL_CHUNK_TOKENS, SMALL_CHUNK_OVERLAP = 512, 64
+
 large_splitter = TokenTextSplitter.from_huggingface_tokenizer(
-    tokenizer=tokenizer, chunk_size=8000, chunk_overlap=128
+    tokenizer=tokenizer, chunk_size=LARGE_CHUNK_TOKENS, chunk_overlap=LARGE_CHUNK_OVERLAP
 )
 small_splitter = TokenTextSplitter.from_huggingface_tokenizer(
-    tokenizer=tokenizer, chunk_size=512, chunk_overlap=64
+    tokenizer=tokenizer, chunk_size=SMALL_CHUNK_TOKENS, chunk_overlap=SMALL_CHUNK_OVERLAP
 )
 
+# Сколько символов текста страниц копится перед нарезкой на окна при потоковой обработке
+PAGE_BUFFER_CHARS = int(os.getenv("PAGE_BUFFER_CHARS", "200000"))
+
+# Максимум токенов (с учётом паддинга) в одном батче окон, ограничивает память на CPU
+EMBED_BATCH_TOKENS = int(os.getenv("EMBED_BATCH_TOKENS", "32768"))
+
 
 def late_chunking(model_output: torch.Tensor, span_annotations: list):
+    """
+    Усредняет токены каждого чанка одной батчевой операцией (сумма по сегментам через cumsum).
+
+    Args:
+        model_output: Выход модели для батча окон
+        span_annotations (list): Список спанов (start, end) для каждой строки батча
+
+    Returns:
+        np.ndarray: float32 массив (n_chunks, hidden_size), чанки идут по строкам батча по порядку.
+                    Для пустого спана возвращается нулевой вектор, чтобы не сбивать соответствие чанкам
+    """
     token_embeddings = model_output.last_hidden_state  # shape: [batch_size, seq_length, hidden_size]
-    outputs = []
-    for batch in token_embeddings:
-        pooled_embeddings = []
-        for start, end in span_annotations:
-            if start < end:
-                # Среднее по токенам в чанке
-                pooled = batch[start:end].mean(dim=0)
-                pooled_embeddings.append(pooled.detach().cpu().numpy())
-        outputs += pooled_embeddings
-    return outputs
-
-
-def process_large_text(input_text):
-    all_chunks = []
-    all_embeddings = []
+    rows = [row for row, spans in enumerate(span_annotations) for _ in spans]
+    if not rows:
+        return np.zeros((0, token_embeddings.shape[-1]), dtype=np.float32)
+
+    device = token_embeddings.device
+    rows = torch.tensor(rows, device=device)
+    starts = torch.tensor([start for spans in span_annotations for start, _ in spans], device=device)
+    ends = torch.tensor([end for spans in span_annotations for _, end in spans], device=device)
+    ends = torch.maximum(starts, ends)
+
+    # prefix[b, i] = сумма первых i токенов строки b
+    prefix = torch.nn.functional.pad(token_embeddings.float().cumsum(dim=1), (0, 0, 1, 0))
+    sums = prefix[rows, ends] - prefix[rows, starts]
+    pooled = sums / (ends - starts).clamp(min=1).unsqueeze(-1).to(sums.dtype)
+    return np.ascontiguousarray(pooled.detach().cpu().numpy(), dtype=np.float32)
+
 
-    for text in large_splitter.split_text(input_text):
-        text_chunks = small_splitter.split_text(text)
-        all_chunks += text_chunks
-        span_annotations = []
-        current_token = 0
-        for chunk in text_chunks:
-            encoded = tokenizer(chunk, return_tensors='pt')
-            num_tokens = encoded.input_ids.shape[1]
-            span_annotations.append((current_token, current_token + num_tokens))
-            current_token += num_tokens
-
-        batch_text = " ".join(text_chunks)
+def build_spans(text_chunks):
+    """
+    Токенизирует окно один раз и находит токенный спан каждого чанка по offset mapping.
+
+    Args:
+        text_chunks (list): Маленькие чанки одного окна
+
+    Returns:
+        tuple: (input_ids окна, список спанов (start, end) в токенах окна)
+    """
+    # Символьные границы чанков в склеенном тексте окна
+    char_spans = []
+    position = 0
+    for chunk in text_chunks:
+        char_spans.append((position, position + len(chunk)))
+        position += len(chunk) + 1  # пробел между чанками
+
+    encoded = tokenizer(
+        " ".join(text_chunks), return_offsets_mapping=True, return_special_tokens_mask=True
+    )
+    # Спецтокены (CLS, SEP) не относятся ни к одному чанку
+    token_positions = [i for i, special in enumerate(encoded['special_tokens_mask']) if not special]
+    token_starts = [encoded['offset_mapping'][i][0] for i in token_positions]
+    token_ends = [encoded['offset_mapping'][i][1] for i in token_positions]
+
+    span_annotations = []
+    for char_start, char_end in char_spans:
+        # Токены, пересекающиеся с [char_start, char_end)
+        first = bisect.bisect_right(token_ends, char_start)
+        last = bisect.bisect_left(token_starts, char_end)
+        if first < last:
+            span_annotations.append((token_positions[first], token_positions[last - 1] + 1))
+        else:
+            span_annotations.append((0, 0))
+    return encoded['input_ids'], span_annotations
+
+
+def make_batches(lengths, max_batch_tokens=EMBED_BATCH_TOKENS):
+    """
+    Раскладывает окна по батчам близкой длины, чтобы паддинг был минимальным,
+    а batch_size * max_len не превышал max_batch_tokens
+    """
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True)
+    batches = []
+    current = []
+    for idx in order:
+        # Окна идут по убыванию длины, поэтому первое окно в батче самое длинное
+        longest = lengths[current[0]] if current else lengths[idx]
+        if current and longest * (len(current) + 1) > max_batch_tokens:
+            batches.append(current)
+            current = []
+        current.append(idx)
+    if current:
+        batches.append(current)
+    return batches
+
+
+def embed_windows(windows, max_batch_tokens=EMBED_BATCH_TOKENS, use_cache=True):
+    """
+    Считает эмбеддинги чанков для множества окон батчами.
+
+    Args:
+        windows (list): Список окон, каждое окно - список маленьких чанков
+        max_batch_tokens (int): Бюджет токенов на один батч
+        use_cache (bool): Брать и сохранять эмбеддинги окон в дисковом кэше
+
+    Returns:
+        list: Для каждого окна массив (n_chunks, hidden_size) эмбеддингов его чанков, в исходном порядке
+    """
+    results = [None] * len(windows)
+    keys = [window_key(EMBED_MODEL_ID, text_chunks) for text_chunks in windows]
+    # Окна, уже посчитанные раньше, берём из кэша и не гоняем через модель
+    pending = []
+    for i, key in enumerate(keys):
+        if use_cache:
+            results[i] = embedding_cache.get(key)
+        if results[i] is None:
+            pending.append(i)
+
+    input_ids = {}
+    spans = {}
+    for i in pending:
+        input_ids[i], spans[i] = build_spans(windows[i])
+
+    for batch in make_batches([len(input_ids[i]) for i in pending], max_batch_tokens):
+        batch = [pending[j] for j in batch]
+        inputs = tokenizer.pad(
+            {'input_ids': [input_ids[i] for i in batch]}, padding=True, return_tensors='pt'
+        )
         with torch.no_grad():
-            inputs = tokenizer(batch_text, return_tensors='pt')
             model_output = embed_model(**inputs)
 
-        all_embeddings += late_chunking(model_output, span_annotations)
+        pooled = late_chunking(model_output, [spans[i] for i in batch])
+        offset = 0
+        for i in batch:
+            results[i] = pooled[offset:offset + len(spans[i])]
+            offset += len(spans[i])
+            if use_cache:
+                embedding_cache.put(keys[i], results[i])
+    return results
+
+
+def split_text_windows(input_text):
+    """Нарезает текст на окна large_splitter, каждое окно - список маленьких чанков"""
+    return [small_splitter.split_text(text) for text in large_splitter.split_text(input_text)]
+
+
+def process_many_texts(input_texts, max_batch_tokens=EMBED_BATCH_TOKENS):
+    """
+    Обрабатывает очередь документов: окна всех документов идут в общие батчи.
+
+    Returns:
+        list: Тройка (all_chunks, all_embeddings, all_windows) для каждого документа,
+              all_embeddings - float32 массив (n_chunks, hidden_size),
+              all_windows - номер окна документа для каждого чанка
+    """
+    windows = []
+    owners = []
+    for doc_idx, input_text in enumerate(input_texts):
+        for text_chunks in split_text_windows(input_text):
+            windows.append(text_chunks)
+            owners.append(doc_idx)
+
+    chunks = [[] for _ in input_texts]
+    embeddings = [[] for _ in input_texts]
+    window_indices = [[] for _ in input_texts]
+    window_counts = [0 for _ in input_texts]
+    for doc_idx, text_chunks, window_embeddings in zip(owners, windows, embed_windows(windows, max_batch_tokens)):
+        chunks[doc_idx].extend(text_chunks)
+        embeddings[doc_idx].append(window_embeddings)
+        window_indices[doc_idx].extend([window_counts[doc_idx]] * len(text_chunks))
+        window_counts[doc_idx] += 1
+
+    hidden_size = embed_model.config.hidden_size
+    return [
+        (
+            doc_chunks,
+            np.concatenate(doc_embeddings) if doc_embeddings else np.zeros((0, hidden_size), np.float32),
+            doc_windows
+        )
+        for doc_chunks, doc_embeddings, doc_windows in zip(chunks, embeddings, window_indices)
+    ]
+
+
+def process_large_text(input_text, max_batch_tokens=EMBED_BATCH_TOKENS):
+    return process_many_texts([input_text], max_batch_tokens)[0]
+
+
+def _token_ranges(start, end, size, overlap):
+    """Диапазоны токенов [start, end) по size с перекрытием overlap, как у TokenTextSplitter"""
+    ranges = []
+    while start < end:
+        ranges.append((start, min(start + size, end)))
+        if ranges[-1][1] == end:
+            break
+        start += size - overlap
+    return ranges
+
+
+def _split_buffer(page_texts, page_numbers, keep_last):
+    """
+    Нарезает накопленные страницы на окна и чанки, определяя страницу каждого чанка.
+    Буфер токенизируется один раз с offset mapping: окна и чанки - диапазоны токенов, текст чанка -
+    срез исходного буфера, а страница берётся по позиции первого символа чанка. Поиск декодированного
+    текста в буфере не годится: токенизатор нормализует пробелы и переводы строк
+
+    Returns:
+        tuple: (список (чанки окна, страницы чанков), остаток страниц для следующего буфера)
+    """
+    page_starts = []
+    offset = 0
+    for text in page_texts:
+        page_starts.append(offset)
+        offset += len(text)
+    buffer = "".join(page_texts)
+    offsets = tokenizer(buffer, add_special_tokens=False, return_offsets_mapping=True, verbose=False)['offset_mapping']
+
+    windows = _token_ranges(0, len(offsets), LARGE_CHUNK_TOKENS, LARGE_CHUNK_OVERLAP)
+    carry = windows.pop() if keep_last and len(windows) > 1 else None
+
+    def page_at(position):
+        return page_numbers[max(bisect.bisect_right(page_starts, position) - 1, 0)]
+
+    result = []
+    for window_start, window_end in windows:
+        text_chunks = []
+        chunk_pages = []
+        for chunk_start, chunk_end in _token_ranges(window_start, window_end, SMALL_CHUNK_TOKENS, SMALL_CHUNK_OVERLAP):
+            chunk_at = offsets[chunk_start][0]
+            text = buffer[chunk_at:offsets[chunk_end - 1][1]]
+            if text.strip():
+                text_chunks.append(text)
+                chunk_pages.append(page_at(chunk_at))
+        if text_chunks:
+            result.append((text_chunks, chunk_pages))
+
+    if carry is None:
+        return result, ([], [])
+    # Последнее окно переносится в следующий буфер с точной позиции своего первого токена
+    carry_at = offsets[carry[0]][0]
+    first_page = max(bisect.bisect_right(page_starts, carry_at) - 1, 0)
+    rest_texts = [buffer[carry_at:page_starts[first_page + 1]] if first_page + 1 < len(page_starts) else buffer[carry_at:]]
+    rest_texts += page_texts[first_page + 1:]
+    return result, (rest_texts, page_numbers[first_page:])
+
+
+def split_page_stream(pages, buffer_chars=PAGE_BUFFER_CHARS):
+    """
+    Потоково нарезает страницы на окна: в памяти держится только буфер из нескольких страниц.
+    Последнее окно буфера переносится в следующий буфер, чтобы окна не рвались на границе
+
+    Args:
+        pages: Итератор (номер страницы, текст)
+
+    Yields:
+        list: Пачка окон, каждое окно - (чанки, номера страниц чанков)
+    """
+    page_texts = []
+    page_numbers = []
+    buffered = 0
+    for page_number, text in pages:
+        page_texts.append(text)
+        page_numbers.append(page_number)
+        buffered += len(text)
+        if buffered >= buffer_chars:
+            windows, (page_texts, page_numbers) = _split_buffer(page_texts, page_numbers, keep_last=True)
+            buffered = sum(len(text) for text in page_texts)
+            if windows:
+                yield windows
+    if page_texts:
+        windows, _ = _split_buffer(page_texts, page_numbers, keep_last=False)
+        if windows:
+            yield windows
+
+
+def process_page_stream(pages, max_batch_tokens=EMBED_BATCH_TOKENS):
+    """
+    Аналог process_large_text для потока страниц.
+
+    Returns:
+        tuple: (all_chunks, all_embeddings, all_pages, all_windows) -
+               номер страницы и номер окна для каждого чанка
+    """
+    all_chunks = []
+    all_pages = []
+    all_windows = []
+    all_embeddings = []
+    window_index = 0
+    for windows in split_page_stream(pages):
+        for (text_chunks, chunk_pages), embeddings in zip(
+                windows, embed_windows([text_chunks for text_chunks, _ in windows], max_batch_tokens)
+        ):
+            all_chunks.extend(text_chunks)
+            all_pages.extend(chunk_pages)
+            all_windows.extend([window_index] * len(text_chunks))
+            all_embeddings.append(embeddings)
+            window_index += 1
 
-    return all_chunks, all_embeddings
+    if not all_embeddings:
+        return [], np.zeros((0, embed_model.config.hidden_size), np.float32), [], []
+    return all_chunks, np.concatenate(all_embeddings), all_pages, all_windows
@@ -0,0 +1,75 @@
+"""
+Постраничное извлечение текста из PDF.
+Модуль намеренно лёгкий (только PyMuPDF), чтобы процессы пула не тянули за собой модель и Chroma
+"""
+import os
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import fitz  # PyMuPDF for PDF handling
+
+# С какого числа страниц имеет смысл раскидывать документ по процессам
+PDF_PARALLEL_MIN_PAGES = int(os.getenv("PDF_PARALLEL_MIN_PAGES", "64"))
+PDF_PAGES_PER_TASK = int(os.getenv("PDF_PAGES_PER_TASK", "32"))
+PDF_WORKERS = int(os.getenv("PDF_WORKERS", str(min(4, os.cpu_count() or 1))))
+# fork копировал бы процесс сервиса целиком, вместе с потоками, моделью и открытыми соединениями
+PDF_START_METHOD = os.getenv("PDF_START_METHOD", "forkserver")
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def process_context():
+    """Контекст multiprocessing для пулов разбора (здесь и в bulk_ingest)"""
+    context = multiprocessing.get_context(PDF_START_METHOD)
+    if PDF_START_METHOD == "forkserver":
+        # По умолчанию forkserver заранее импортирует __main__, то есть app.py / bulk_ingest.py вместе с моделью.
+        # Воркерам нужен только этот модуль, остальное (html2markdown) импортируется в них по требованию
+        context.set_forkserver_preload([__name__])
+    return context
+
+
+def get_pdf_pool() -> ProcessPoolExecutor:
+    """Общий пул процессов на весь сервис, создаётся при первом большом PDF"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=PDF_WORKERS, mp_context=process_context())
+        return _pool
+
+
+def _extract_page_range(pdf_path: str, start: int, end: int):
+    with fitz.open(pdf_path) as pdf_document:
+        return [pdf_document[i].get_text() for i in range(start, end)]
+
+
+def iter_pdf_pages(pdf_path: str, workers: int = PDF_WORKERS):
+    """
+    Лениво отдаёт текст страниц PDF по порядку.
+    Большие документы делятся на диапазоны страниц и обрабатываются общим пулом процессов (get_pdf_pool)
+
+    Yields:
+        tuple: (номер страницы начиная с 1, текст страницы)
+    """
+    with fitz.open(pdf_path) as pdf_document:
+        page_count = pdf_document.page_count
+        if workers <= 1 or page_count < PDF_PARALLEL_MIN_PAGES:
+            for page in pdf_document:
+                yield page.number + 1, page.get_text()
+            return
+
+    ranges = [(start, min(start + PDF_PAGES_PER_TASK, page_count)) for start in range(0, page_count, PDF_PAGES_PER_TASK)]
+    # map сохраняет порядок диапазонов, результаты отдаются по мере готовности
+    results = get_pdf_pool().map(
+        _extract_page_range, [pdf_path] * len(ranges), [start for start, _ in ranges], [end for _, end in ranges]
+    )
+    for (start, _), texts in zip(ranges, results):
+        for offset, text in enumerate(texts):
+            yield start + offset + 1, text
+
+
+def extract_pdf_pages(pdf_path: str):
+    """Все страницы документа списком (номер страницы, текст), для запуска в пуле процессов"""
+    with fitz.open(pdf_path) as pdf_document:
+        return [(page.number + 1, page.get_text()) for page in pdf_document]
@@ -0,0 +1,109 @@
+"""
+Пост-обработка результатов поиска: отсечение по расстоянию и MMR для разнообразия контекста
+"""
+import os
+from collections import defaultdict
+
+import numpy as np
+
+# Максимальное расстояние Chroma, дальше которого чанк считается нерелевантным. Пусто - без отсечения
+RETRIEVAL_MAX_DISTANCE = float(os.environ["RETRIEVAL_MAX_DISTANCE"]) if os.getenv("RETRIEVAL_MAX_DISTANCE") else None
+# Во сколько раз больше кандидатов запрашивать у коллекции, чем нужно в итоге
+RETRIEVAL_FETCH_FACTOR = int(os.getenv("RETRIEVAL_FETCH_FACTOR", "4"))
+# 1.0 - только релевантность, 0.0 - только разнообразие
+MMR_LAMBDA = float(os.getenv("MMR_LAMBDA", "0.7"))
+# Сглаживающая константа reciprocal rank fusion
+RRF_K = int(os.getenv("RRF_K", "60"))
+
+RESULT_FIELDS = ('ids', 'documents', 'metadatas', 'distances', 'collections')
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def reciprocal_rank_fusion(rankings: list, k: int = RRF_K) -> dict:
+    """
+    Args:
+        rankings (list): Списки ключей, каждый от лучшего к худшему
+
+    Returns:
+        dict: Ключ -> сумма 1 / (k + ранг) по всем спискам
+    """
+    scores = defaultdict(float)
+    for ranking in rankings:
+        for rank, key in enumerate(ranking, start=1):
+            scores[key] += 1 / (k + rank)
+    return dict(scores)
+
+
+def mmr(query_embedding, embeddings, k: int, mmr_lambda: float = MMR_LAMBDA, relevance=None) -> list:
+    """
+    Maximal Marginal Relevance по косинусной близости.
+
+    Args:
+        relevance (optional): Готовые оценки релевантности кандидатов (например RRF) вместо близости к запросу
+
+    Returns:
+        list: Индексы выбранных кандидатов в порядке выбора
+    """
+    embeddings = _normalize(np.asarray(embeddings, dtype=np.float32))
+    query = _normalize(np.asarray(query_embedding, dtype=np.float32))
+    n = embeddings.shape[0]
+    k = min(k, n)
+    if k == 0:
+        return []
+
+    if relevance is None:
+        relevance = embeddings @ query
+    else:
+        # Приводим к масштабу косинусной близости, с которой сравнивается redundancy
+        relevance = np.asarray(relevance, dtype=np.float32)
+        relevance = relevance / max(float(relevance.max()), 1e-12)
+    similarity = embeddings @ embeddings.T
+    selected = [int(np.argmax(relevance))]
+    # Максимальная близость каждого кандидата к уже выбранным
+    redundancy = similarity[selected[0]].copy()
+    available = np.ones(n, dtype=bool)
+    available[selected[0]] = False
+    while len(selected) < k:
+        scores = mmr_lambda * relevance - (1 - mmr_lambda) * redundancy
+        scores[~available] = -np.inf
+        best = int(np.argmax(scores))
+        selected.append(best)
+        available[best] = False
+        np.maximum(redundancy, similarity[best], out=redundancy)
+    return selected
+
+
+def filter_and_diversify(results: dict, query_embedding, n_results: int,
+                         max_distance: float = RETRIEVAL_MAX_DISTANCE, mmr_lambda: float = MMR_LAMBDA) -> dict:
+    """
+    Отбрасывает кандидатов дальше max_distance и выбирает n_results разнообразных через MMR.
+
+    Лексические совпадения (поле lexical) по расстоянию не отсекаются,
+    а при наличии поля scores (RRF) релевантность для MMR берётся из него.
+
+    Args:
+        results (dict): Результат в формате collection.query с embeddings кандидатов
+
+    Returns:
+        dict: Тот же формат без embeddings
+    """
+    # У кандидатов, найденных только BM25, расстояния нет
+    distances = np.array([np.nan if d is None else d for d in results['distances'][0]], dtype=np.float32)
+    keep = np.arange(len(distances))
+    if max_distance is not None:
+        lexical = np.asarray(results.get('lexical', [[False] * len(distances)])[0], dtype=bool)
+        keep = keep[(distances <= max_distance) | lexical]
+
+    embeddings = results.get('embeddings')
+    if embeddings is not None and len(keep) > n_results:
+        candidates = np.asarray(embeddings[0], dtype=np.float32)[keep]
+        relevance = np.asarray(results['scores'][0], dtype=np.float32)[keep] if 'scores' in results else None
+        keep = keep[mmr(query_embedding, candidates, n_results, mmr_lambda, relevance)]
+    else:
+        keep = keep[:n_results]
+
+    return {field: [[results[field][0][i] for i in keep]] for field in RESULT_FIELDS if field in results}
@@ -0,0 +1,125 @@
+"""
+Скользящая сводка длинных чатов.
+В промпт попадают сводка и последние сообщения. Когда сообщений после сводки становится больше
+SUMMARY_RECENT_MESSAGES, фоновая задача сворачивает самые старые из них в сводку (таблица chat_summaries)
+"""
+import os
+import asyncio
+import logging
+
+from langchain_core.prompts import ChatPromptTemplate
+
+import async_db
+from engine import model
+
+logger = logging.getLogger(__name__)
+
+# Сколько последних сообщений остаётся в промпте как есть
+SUMMARY_RECENT_MESSAGES = int(os.getenv("SUMMARY_RECENT_MESSAGES", "6"))
+# Сворачивать, когда за окном накопилось хотя бы столько сообщений (чтобы не звать модель на каждый ответ)
+SUMMARY_MIN_BATCH = int(os.getenv("SUMMARY_MIN_BATCH", "2"))
+SUMMARY_MAX_WORDS = int(os.getenv("SUMMARY_MAX_WORDS", "200"))
+# Сколько сообщений и символов сворачивается за один вызов модели. Длинная история без сводки
+# (например после включения сводок на старых чатах) сворачивается несколькими вызовами
+SUMMARY_MAX_BATCH = int(os.getenv("SUMMARY_MAX_BATCH", "20"))
+SUMMARY_MAX_BATCH_CHARS = int(os.getenv("SUMMARY_MAX_BATCH_CHARS", "12000"))
+# Сколько сводок одновременно, модель общая с ответами
+SUMMARY_WORKERS = int(os.getenv("SUMMARY_WORKERS", "1"))
+
+SUMMARY_TEMPLATE = """
+Update the running summary of a conversation between a user and an assistant.
+Current summary:
+{summary}
+---
+Messages to add:
+{messages}
+---
+Write the updated summary in the language of the conversation, at most {max_words} words.
+Keep facts, names, numbers and unresolved questions. Output only the summary.
+"""
+summary_template = ChatPromptTemplate.from_template(SUMMARY_TEMPLATE)
+
+
+def summary_prompt_suffix(summary: str) -> str:
+    """Добавка к системному сообщению с содержанием ранней части разговора"""
+    return f"\n\nSummary of the earlier conversation:\n{summary}" if summary else ""
+
+
+class ChatSummarizer:
+    """Фоновые обновления сводок: не больше одной задачи на чат, повторный вызов во время работы перезапустит её"""
+
+    def __init__(self, concurrency: int = SUMMARY_WORKERS):
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._tasks = {}
+        self._dirty = set()
+
+    def schedule(self, chat_id: int):
+        if chat_id in self._tasks:
+            self._dirty.add(chat_id)
+            return
+        self._tasks[chat_id] = asyncio.create_task(self._run(chat_id))
+
+    async def stop(self):
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._tasks.clear()
+        self._dirty.clear()
+
+    async def _run(self, chat_id: int):
+        try:
+            while True:
+                self._dirty.discard(chat_id)
+                try:
+                    async with self._semaphore:
+                        await self.update(chat_id)
+                except Exception as e:
+                    logger.error(f"Could not update summary of chat {chat_id}: {e}")
+                if chat_id not in self._dirty:
+                    break
+        finally:
+            self._tasks.pop(chat_id, None)
+
+    async def update(self, chat_id: int):
+        """
+        Сворачивает в сводку сообщения, вышедшие за окно последних SUMMARY_RECENT_MESSAGES,
+        пачками не больше SUMMARY_MAX_BATCH сообщений и SUMMARY_MAX_BATCH_CHARS символов
+        """
+        current = await async_db.get_chat_summary(chat_id)
+        summary = current['summary'] if current else None
+        last_message_id = current['last_message_id'] if current else 0
+        while True:
+            messages = await async_db.get_messages_after(
+                chat_id, last_message_id, limit=SUMMARY_MAX_BATCH + SUMMARY_RECENT_MESSAGES
+            )
+            stale = messages[:len(messages) - SUMMARY_RECENT_MESSAGES]
+            if len(stale) < SUMMARY_MIN_BATCH:
+                return
+            stale = self._limit_chars(stale)
+
+            prompt = summary_template.format(
+                summary=summary or "(empty)",
+                # Одно сообщение длиннее лимита обрезается, чтобы промпт оставался ограниченным
+                messages="\n".join(
+                    f"{message['author']}: {message['text'][:SUMMARY_MAX_BATCH_CHARS]}" for message in stale
+                ),
+                max_words=SUMMARY_MAX_WORDS
+            )
+            summary = (await model.ainvoke(prompt)).strip()
+            last_message_id = stale[-1]['id']
+            await async_db.save_chat_summary(chat_id, summary, last_message_id)
+            logger.info(f"Chat {chat_id} summary now covers messages up to {last_message_id}")
+
+    @staticmethod
+    def _limit_chars(messages: list) -> list:
+        """Первые сообщения, укладывающиеся в SUMMARY_MAX_BATCH_CHARS, но хотя бы одно"""
+        total = 0
+        for i, message in enumerate(messages):
+            total += len(message['text'])
+            if i and total > SUMMARY_MAX_BATCH_CHARS:
+                return messages[:i]
+        return messages
+
+
+chat_summarizer = ChatSummarizer()
@@ -1,14 +1,205 @@
-import html2text
+import os
+import time
+import sqlite3
+import asyncio
+import hashlib
+import logging
+import threading
+from dataclasses import dataclass
+from typing import Optional
+from urllib.parse import urlparse
 
+import aiohttp
+import html2text
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
+logger = logging.getLogger(__name__)
+
+FETCH_TIMEOUT = float(os.getenv("FETCH_TIMEOUT", "20"))
+FETCH_RETRIES = int(os.getenv("FETCH_RETRIES", "3"))
+FETCH_PER_HOST = int(os.getenv("FETCH_PER_HOST", "4"))
+FETCH_TOTAL = int(os.getenv("FETCH_TOTAL", "32"))
+CRAWL_CACHE_PATH = os.getenv("CRAWL_CACHE_PATH", os.path.join("data", "crawl_cache.sqlite"))
+USER_AGENT = "window-of-knowledge/1.0"
+# Ответы, после которых загрузка повторяется. Остальные 4xx/5xx - сразу ошибка
+RETRY_STATUSES = (429, 500, 502, 503, 504)
 
-def url2text(url: str):
-    # TODO обработка ошибок, с url
 
+@dataclass
+class FetchResult:
+    url: str
+    text: Optional[str] = None
+    # False, если сервер ответил 304 и текст взят из кэша
+    changed: bool = True
+    error: Optional[str] = None
+    # Для fetch_url(convert=False): HTML и заголовки для crawl_cache, текст получает convert_fetched
+    html: Optional[str] = None
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+
+
+def html2markdown(html: str) -> str:
+    # HTML2Text хранит состояние разбора документа, поэтому экземпляр на каждый документ
     h = html2text.HTML2Text()
     h.ignore_images = True  # Ignore images
     h.ignore_links = True  # Ignore external links
-    response = requests.get(url)
-    markdown_text = h.handle(response.text)
-    return markdown_text
+    return h.handle(html)
+
+
+class CrawlCache:
+    """ETag / Last-Modified и текст последней загруженной версии страницы, для conditional GET"""
+
+    def __init__(self, path: str = CRAWL_CACHE_PATH):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS pages (
+                url TEXT PRIMARY KEY,
+                etag TEXT,
+                last_modified TEXT,
+                content_hash TEXT NOT NULL,
+                text TEXT NOT NULL,
+                fetched_at REAL NOT NULL
+            )
+            """
+        )
+        self._conn.commit()
+
+    def get(self, url: str):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT etag, last_modified, content_hash, text FROM pages WHERE url = ?", (url,)
+            ).fetchone()
+        if row is None:
+            return None
+        return {"etag": row[0], "last_modified": row[1], "content_hash": row[2], "text": row[3]}
+
+    def conditional_headers(self, url: str) -> dict:
+        cached = self.get(url)
+        headers = {}
+        if cached:
+            if cached["etag"]:
+                headers["If-None-Match"] = cached["etag"]
+            if cached["last_modified"]:
+                headers["If-Modified-Since"] = cached["last_modified"]
+        return headers
+
+    def put(self, url: str, etag: str, last_modified: str, text: str) -> bool:
+        """Сохраняет страницу, возвращает True, если текст изменился"""
+        content_hash = hashlib.sha256(text.encode('utf-8')).hexdigest()
+        cached = self.get(url)
+        with self._lock:
+            self._conn.execute(
+                """
+                INSERT OR REPLACE INTO pages (url, etag, last_modified, content_hash, text, fetched_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+                """,
+                (url, etag, last_modified, content_hash, text, time.time())
+            )
+            self._conn.commit()
+        return cached is None or cached["content_hash"] != content_hash
+
+
+crawl_cache = CrawlCache()
+
+
+def _make_session():
+    session = requests.Session()
+    retry = Retry(
+        total=FETCH_RETRIES, backoff_factor=0.5, status_forcelist=RETRY_STATUSES,
+        allowed_methods=("GET",)
+    )
+    adapter = HTTPAdapter(max_retries=retry, pool_connections=FETCH_TOTAL, pool_maxsize=FETCH_PER_HOST)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers["User-Agent"] = USER_AGENT
+    return session
+
+
+# Общая keep-alive сессия для синхронных загрузок
+http_session = _make_session()
+
+
+def fetch_url(url: str, convert: bool = True) -> FetchResult:
+    """
+    Синхронная загрузка страницы через общую сессию с conditional GET
+
+    Args:
+        convert (bool): Сразу перевести HTML в markdown. False - только загрузка, text будет заполнен
+            лишь при ответе 304, а HTML переводится позже через html2markdown и convert_fetched
+    """
+    response = http_session.get(url, headers=crawl_cache.conditional_headers(url), timeout=FETCH_TIMEOUT)
+    if response.status_code == 304:
+        return FetchResult(url, text=crawl_cache.get(url)["text"], changed=False)
+    response.raise_for_status()
+    result = FetchResult(
+        url, html=response.text, etag=response.headers.get("ETag"),
+        last_modified=response.headers.get("Last-Modified")
+    )
+    return convert_fetched(result, html2markdown(result.html)) if convert else result
+
+
+def convert_fetched(result: FetchResult, text: str) -> FetchResult:
+    """Сохраняет в crawl_cache текст страницы, загруженной fetch_url(convert=False)"""
+    changed = crawl_cache.put(result.url, result.etag, result.last_modified, text)
+    return FetchResult(result.url, text=text, changed=changed)
+
+
+def url2text(url: str):
+    return fetch_url(url).text
+
+
+async def _fetch_one(session: aiohttp.ClientSession, url: str, host_limits: dict) -> FetchResult:
+    host = urlparse(url).netloc
+    semaphore = host_limits.setdefault(host, asyncio.Semaphore(FETCH_PER_HOST))
+    last_error = None
+    for attempt in range(FETCH_RETRIES + 1):
+        if attempt:
+            await asyncio.sleep(0.5 * 2 ** (attempt - 1))
+        try:
+            async with semaphore:
+                async with session.get(url, headers=crawl_cache.conditional_headers(url)) as response:
+                    if response.status == 304:
+                        return FetchResult(url, text=crawl_cache.get(url)["text"], changed=False)
+                    if response.status in RETRY_STATUSES:
+                        last_error = f"HTTP {response.status}"
+                        continue
+                    if response.status >= 400:
+                        # ClientResponseError из raise_for_status попал бы в повтор ниже как ClientError
+                        logger.error(f"Failed to fetch {url}: HTTP {response.status}")
+                        return FetchResult(url, error=f"HTTP {response.status} {response.reason}")
+                    html = await response.text()
+                    etag = response.headers.get("ETag")
+                    last_modified = response.headers.get("Last-Modified")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            last_error = str(e) or type(e).__name__
+            continue
+        # Конвертация в markdown - CPU работа, уносим из event loop
+        text = await asyncio.to_thread(html2markdown, html)
+        changed = await asyncio.to_thread(crawl_cache.put, url, etag, last_modified, text)
+        return FetchResult(url, text=text, changed=changed)
+    logger.error(f"Failed to fetch {url}: {last_error}")
+    return FetchResult(url, error=last_error)
+
+
+async def fetch_urls(urls: list) -> list:
+    """
+    Параллельно загружает список URL через одну keep-alive сессию.
+    Не больше FETCH_PER_HOST одновременных запросов к одному хосту и FETCH_TOTAL всего
+
+    Returns:
+        list: FetchResult для каждого URL в исходном порядке
+    """
+    connector = aiohttp.TCPConnector(limit=FETCH_TOTAL, limit_per_host=FETCH_PER_HOST)
+    timeout = aiohttp.ClientTimeout(total=FETCH_TIMEOUT)
+    host_limits = {}
+    async with aiohttp.ClientSession(
+            connector=connector, timeout=timeout, headers={"User-Agent": USER_AGENT}
+    ) as session:
+        return await asyncio.gather(*[_fetch_one(session, url, host_limits) for url in urls])
@@ -0,0 +1,613 @@
+"""
+Встроенное векторное хранилище без HTTP сервера.
+Повторяет ту часть API коллекций Chroma, которой пользуется проект (upsert/get/query/delete/count/modify),
+поэтому подключается через CollectionRegistry вместо chromadb.HttpClient.
+
+Каждая коллекция - каталог:
+    vectors.bin       матрица для поиска (float32, float16 или int8), только дописывается, читается через memmap
+    vectors_full.bin  те же векторы в float32 для точного пересчёта кандидатов, если vectors.bin сжат
+    quantizer.npy     калибровка int8 (нижняя граница и шаг по каждой координате)
+    rows.sqlite       id, текст, метаданные и номер IVF списка для каждой строки матрицы
+    centroids.npy     центроиды IVF, появляются после LOCAL_IVF_MIN_ROWS векторов
+Расстояния - квадрат L2, как у коллекций Chroma по умолчанию.
+
+При float16 / int8 поиск идёт по сжатой матрице, а LOCAL_RESCORE_FACTOR * n_results лучших кандидатов
+пересчитываются по float32 с диска, так что в памяти держится в основном сжатая матрица
+
+Каталог могут открыть несколько процессов (сервис и bulk_ingest). Запись идёт под эксклюзивной
+блокировкой write.lock, каждая запись увеличивает generation в rows.sqlite. Перед чтением и записью
+коллекция сверяет generation со своей и, если другой процесс что-то записал, перечитывает состояние
+"""
+import os
+import json
+import fcntl
+import shutil
+import sqlite3
+import logging
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+LOCAL_STORE_DIR = os.getenv("LOCAL_STORE_DIR", os.path.join("data", "vector_store"))
+LOCAL_STORE_DTYPE = os.getenv("LOCAL_STORE_DTYPE", "float32")
+# С какого размера коллекции строится IVF индекс, до этого поиск полным перебором
+LOCAL_IVF_MIN_ROWS = int(os.getenv("LOCAL_IVF_MIN_ROWS", "50000"))
+# Сколько ближайших IVF списков просматривается при поиске
+LOCAL_IVF_NPROBE = int(os.getenv("LOCAL_IVF_NPROBE", "16"))
+# Во сколько раз больше кандидатов пересчитывается в полной точности при сжатом хранении
+LOCAL_RESCORE_FACTOR = int(os.getenv("LOCAL_RESCORE_FACTOR", "4"))
+# Сколько векторов нужно для калибровки int8. До калибровки поиск идёт по float32
+LOCAL_CALIBRATION_ROWS = int(os.getenv("LOCAL_CALIBRATION_ROWS", "1024"))
+# Сколько удалённых строк копится в vectors.bin до перезаписи файла
+LOCAL_COMPACT_MIN_ROWS = int(os.getenv("LOCAL_COMPACT_MIN_ROWS", "4096"))
+
+_SQL_BATCH = 500
+# Строк на один проход по матрице: при dim 1024 это 32 МБ float32 на копию
+_ROW_BATCH = 8192
+
+
+class CollectionNotFoundError(ValueError):
+    """Коллекции нет. Наследует ValueError, как ошибка старых версий Chroma"""
+
+
+def _matches(metadata: dict, where: dict) -> bool:
+    """Фильтр where: только точное совпадение полей метаданных"""
+    for key, value in where.items():
+        if key.startswith("$") or isinstance(value, dict):
+            raise ValueError(f"Unsupported where clause: {key}")
+        if (metadata or {}).get(key) != value:
+            return False
+    return True
+
+
+def _kmeans(vectors: np.ndarray, k: int, iterations: int = 10, seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), size=k, replace=False)].copy()
+    for _ in range(iterations):
+        assign = _nearest(vectors, centroids)
+        for i in range(k):
+            members = vectors[assign == i]
+            if len(members):
+                centroids[i] = members.mean(axis=0)
+    return centroids
+
+
+def _nearest(vectors: np.ndarray, centroids: np.ndarray, batch: int = 8192) -> np.ndarray:
+    centroid_norms = np.einsum('ij,ij->i', centroids, centroids)
+    result = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), batch):
+        chunk = np.asarray(vectors[start:start + batch], dtype=np.float32)
+        result[start:start + batch] = np.argmin(centroid_norms - 2 * chunk @ centroids.T, axis=1)
+    return result
+
+
+class LocalCollection:
+    def __init__(self, store, name: str, directory: str, dtype: str = LOCAL_STORE_DTYPE):
+        self._store = store
+        self.name = name
+        self.directory = directory
+        self._default_dtype = dtype
+        self._lock = threading.RLock()
+        self._file_lock_depth = 0
+        os.makedirs(directory, exist_ok=True)
+        self._open()
+
+    @property
+    def _vectors_path(self):
+        return os.path.join(self.directory, "vectors.bin")
+
+    @property
+    def _full_path(self):
+        # При float32 отдельная копия не нужна
+        if self.dtype == np.float32:
+            return self._vectors_path
+        return os.path.join(self.directory, "vectors_full.bin")
+
+    @property
+    def _quantizer_path(self):
+        return os.path.join(self.directory, "quantizer.npy")
+
+    @property
+    def _centroids_path(self):
+        return os.path.join(self.directory, "centroids.npy")
+
+    @property
+    def _lock_path(self):
+        return os.path.join(self.directory, "write.lock")
+
+    @property
+    def _has_codes(self) -> bool:
+        """Есть ли сжатая матрица отдельно от float32 (int8 появляется только после калибровки)"""
+        return self.dtype != np.float32 and (self.dtype != np.int8 or self._quantizer is not None)
+
+    def _file_rows(self, path: str, dtype) -> int:
+        if not os.path.exists(path):
+            return 0
+        return os.path.getsize(path) // (self.dim * np.dtype(dtype).itemsize)
+
+    def _open(self):
+        self._db = sqlite3.connect(os.path.join(self.directory, "rows.sqlite"), check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS rows ("
+            "row INTEGER PRIMARY KEY, id TEXT UNIQUE NOT NULL, document TEXT, metadata TEXT, list INTEGER)"
+        )
+        self._db.execute("CREATE TABLE IF NOT EXISTS info (key TEXT PRIMARY KEY, value TEXT)")
+        self._db.commit()
+        with self._file_lock(exclusive=False):
+            self._load()
+
+    @contextmanager
+    def _file_lock(self, exclusive: bool):
+        """flock на write.lock. Повторный вход из того же потока (upsert -> _maintain -> calibrate) не блокирует"""
+        if self._file_lock_depth:
+            self._file_lock_depth += 1
+            try:
+                yield
+            finally:
+                self._file_lock_depth -= 1
+            return
+        with open(self._lock_path, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            self._file_lock_depth = 1
+            try:
+                yield
+            finally:
+                self._file_lock_depth = 0
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _disk_generation(self) -> int:
+        row = self._db.execute("SELECT value FROM info WHERE key = 'generation'").fetchone()
+        return int(row[0]) if row else 0
+
+    def _refresh(self):
+        """Перечитывает коллекцию, если её изменил другой процесс. Вызывается под self._lock"""
+        if self._disk_generation() != self._generation:
+            with self._file_lock(exclusive=False):
+                self._load()
+
+    @contextmanager
+    def _writing(self):
+        """Запись: поток и процесс единственные пишущие, состояние в памяти совпадает с диском"""
+        with self._lock, self._file_lock(exclusive=True):
+            if self._disk_generation() != self._generation:
+                self._load()
+            yield
+
+    def _bump_generation(self):
+        """В той же транзакции, что и изменение строк"""
+        self._generation += 1
+        self._set_info('generation', self._generation)
+
+    def _set_info(self, key: str, value):
+        self._db.execute("INSERT OR REPLACE INTO info (key, value) VALUES (?, ?)", (key, str(value)))
+
+    def _load(self):
+        info = dict(self._db.execute("SELECT key, value FROM info").fetchall())
+        self.dtype = np.dtype(info.get('dtype', self._default_dtype))
+        self.dim = int(info['dim']) if 'dim' in info else None
+        self._trained_rows = int(info.get('trained_rows', 0))
+        self._generation = int(info.get('generation', 0))
+        self._quantizer = np.load(self._quantizer_path) if os.path.exists(self._quantizer_path) else None
+
+        size = 0
+        if self.dim is not None:
+            size = self._file_rows(self._full_path, np.float32)
+            if self._has_codes:
+                size = min(size, self._file_rows(self._vectors_path, self.dtype))
+        self._size = size
+        self._row_ids = [None] * size
+        self._documents = [None] * size
+        self._metadatas = [None] * size
+        self._lists = np.full(size, -1, dtype=np.int32)
+        self._alive = np.zeros(size, dtype=bool)
+        self._rows = {}
+        # Строки без записи в SQLite (сбой между записью вектора и коммитом) считаются удалёнными
+        for row, id_, document, metadata, list_ in self._db.execute(
+                "SELECT row, id, document, metadata, list FROM rows WHERE row < ?", (size,)
+        ):
+            self._row_ids[row] = id_
+            self._documents[row] = document
+            self._metadatas[row] = json.loads(metadata) if metadata else None
+            self._lists[row] = -1 if list_ is None else list_
+            self._alive[row] = True
+            self._rows[id_] = row
+
+        self._remap()
+        self._norms = self._row_norms(0, size)
+        self._centroids = np.load(self._centroids_path) if os.path.exists(self._centroids_path) else None
+        self._inverted = None
+
+    def _remap(self):
+        """_full - float32 векторы, _matrix - матрица для поиска (тот же объект, если сжатия нет)"""
+        self._matrix = self._full = None
+        if self._size:
+            shape = (self._size, self.dim)
+            self._full = np.memmap(self._full_path, dtype=np.float32, mode='r', shape=shape)
+            self._matrix = self._full
+            if self._has_codes:
+                self._matrix = np.memmap(self._vectors_path, dtype=self.dtype, mode='r', shape=shape)
+
+    def _encode(self, vectors: np.ndarray) -> np.ndarray:
+        if self.dtype == np.int8:
+            low, step = self._quantizer
+            return np.clip(np.rint((vectors - low) / step) - 128, -128, 127).astype(np.int8)
+        return vectors.astype(self.dtype)
+
+    def _decode(self, codes) -> np.ndarray:
+        if codes.dtype == np.int8:
+            low, step = self._quantizer
+            return low + step * (codes.astype(np.float32) + 128)
+        return np.asarray(codes, dtype=np.float32)
+
+    def _dot(self, vectors, query: np.ndarray) -> np.ndarray:
+        """Скалярные произведения строк матрицы поиска с запросом, по частям, без распаковки всей матрицы"""
+        if vectors.dtype == np.int8:
+            # low + step * (c + 128) раскрывается так, что матрица умножается на query * step как есть
+            low, step = self._quantizer
+            query, shift = query * step, float(query @ (low + 128 * step))
+        else:
+            shift = 0.0
+        result = np.empty(len(vectors), dtype=np.float32)
+        for start in range(0, len(vectors), _ROW_BATCH):
+            result[start:start + _ROW_BATCH] = np.asarray(vectors[start:start + _ROW_BATCH], dtype=np.float32) @ query
+        return result + shift
+
+    def _row_norms(self, start: int, end: int, batch: int = 8192) -> np.ndarray:
+        """Квадраты норм строк в том виде, в каком они лежат в матрице поиска"""
+        norms = np.empty(end - start, dtype=np.float32)
+        for offset in range(start, end, batch):
+            chunk = self._decode(self._matrix[offset:min(offset + batch, end)])
+            norms[offset - start:offset - start + len(chunk)] = np.einsum('ij,ij->i', chunk, chunk)
+        return norms
+
+    def _append(self, path: str, start: int, array: np.ndarray):
+        with open(path, 'ab') as f:
+            # Хвост от неудачной прошлой записи отрезается, чтобы номер строки совпадал с позицией в файле
+            f.truncate(start * self.dim * array.dtype.itemsize)
+            f.write(array.tobytes())
+
+    def count(self) -> int:
+        with self._lock:
+            self._refresh()
+            return len(self._rows)
+
+    def modify(self, name: str):
+        self._store._rename(self, name)
+
+    def upsert(self, ids: list, embeddings, documents: list = None, metadatas: list = None):
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        documents = documents if documents is not None else [None] * len(ids)
+        metadatas = metadatas if metadatas is not None else [None] * len(ids)
+        # Повтор id внутри одного вызова: остаётся последняя версия
+        keep = sorted({id_: i for i, id_ in enumerate(ids)}.values())
+        if len(keep) != len(ids):
+            ids = [ids[i] for i in keep]
+            documents = [documents[i] for i in keep]
+            metadatas = [metadatas[i] for i in keep]
+            embeddings = embeddings[keep]
+        if not ids:
+            return
+
+        with self._writing():
+            if self.dim is None:
+                self.dim = embeddings.shape[1]
+                self._set_info('dim', self.dim)
+                self._set_info('dtype', self.dtype.name)
+            if embeddings.shape[1] != self.dim:
+                raise ValueError(f"Embedding dimension {embeddings.shape[1]} does not match collection {self.dim}")
+
+            lists = _nearest(embeddings, self._centroids) if self._centroids is not None else np.full(len(ids), -1)
+            start = self._size
+            self._append(self._full_path, start, embeddings)
+            if self._has_codes:
+                self._append(self._vectors_path, start, self._encode(embeddings))
+            # INSERT OR REPLACE по уникальному id заодно удаляет прошлую версию чанка
+            self._db.executemany(
+                "INSERT OR REPLACE INTO rows (row, id, document, metadata, list) VALUES (?, ?, ?, ?, ?)",
+                [
+                    (start + i, id_, document, json.dumps(metadata, ensure_ascii=False) if metadata else None, int(l))
+                    for i, (id_, document, metadata, l) in enumerate(zip(ids, documents, metadatas, lists))
+                ]
+            )
+            self._bump_generation()
+            self._db.commit()
+
+            for id_ in ids:
+                old = self._rows.get(id_)
+                if old is not None:
+                    self._kill(old)
+            self._size += len(ids)
+            self._row_ids.extend(ids)
+            self._documents.extend(documents)
+            self._metadatas.extend(metadatas)
+            self._lists = np.concatenate([self._lists, np.asarray(lists, dtype=np.int32)])
+            self._alive = np.concatenate([self._alive, np.ones(len(ids), dtype=bool)])
+            for i, id_ in enumerate(ids):
+                self._rows[id_] = start + i
+            self._remap()
+            self._norms = np.concatenate([self._norms, self._row_norms(start, self._size)])
+            self._inverted = None
+            self._maintain()
+
+    add = upsert
+
+    def _kill(self, row: int):
+        self._alive[row] = False
+        self._row_ids[row] = self._documents[row] = self._metadatas[row] = None
+
+    def delete(self, ids: list = None, where: dict = None):
+        with self._writing():
+            rows = self._select(ids, where)
+            if not rows:
+                return
+            removed = [self._row_ids[row] for row in rows]
+            for start in range(0, len(removed), _SQL_BATCH):
+                batch = removed[start:start + _SQL_BATCH]
+                self._db.execute(f"DELETE FROM rows WHERE id IN ({','.join('?' * len(batch))})", batch)
+            self._bump_generation()
+            self._db.commit()
+            for id_, row in zip(removed, rows):
+                del self._rows[id_]
+                self._kill(row)
+            self._inverted = None
+            self._maintain()
+
+    def _select(self, ids: list = None, where: dict = None) -> list:
+        if ids is not None:
+            rows = [self._rows[id_] for id_ in ids if id_ in self._rows]
+        else:
+            rows = sorted(self._rows.values())
+        if where:
+            rows = [row for row in rows if _matches(self._metadatas[row], where)]
+        return rows
+
+    def _fields(self, rows: list, include) -> dict:
+        result = {'ids': [self._row_ids[row] for row in rows]}
+        if "documents" in include:
+            result['documents'] = [self._documents[row] for row in rows]
+        if "metadatas" in include:
+            result['metadatas'] = [self._metadatas[row] for row in rows]
+        if "embeddings" in include:
+            result['embeddings'] = (
+                np.asarray(self._full[rows], dtype=np.float32) if rows else np.empty((0, self.dim or 0), np.float32)
+            )
+        return result
+
+    def get(self, ids: list = None, where: dict = None, limit: int = None, offset: int = 0,
+            include=("documents", "metadatas")):
+        with self._lock:
+            self._refresh()
+            rows = self._select(ids, where)
+            rows = rows[offset:None if limit is None else offset + limit]
+            return self._fields(rows, include)
+
+    def query(self, query_embeddings, n_results: int = 10, include=("documents", "metadatas", "distances")):
+        queries = np.atleast_2d(np.asarray(query_embeddings, dtype=np.float32))
+        with self._lock:
+            self._refresh()
+            results = {}
+            for query in queries:
+                rows, distances = self._search(query, n_results)
+                for key, value in self._fields(rows, include).items():
+                    results.setdefault(key, []).append(value)
+                if "distances" in include:
+                    results.setdefault('distances', []).append(distances)
+            return results
+
+    def _candidates(self, query: np.ndarray, n_results: int):
+        """Строки из ближайших IVF списков или None, если нужен полный перебор"""
+        if self._centroids is None:
+            return None
+        if self._inverted is None:
+            alive_rows = np.flatnonzero(self._alive)
+            order = np.argsort(self._lists[alive_rows], kind='stable')
+            sorted_rows = alive_rows[order]
+            bounds = np.searchsorted(self._lists[sorted_rows], np.arange(len(self._centroids) + 1))
+            self._inverted = [sorted_rows[bounds[i]:bounds[i + 1]] for i in range(len(self._centroids))]
+        centroid_distances = np.einsum('ij,ij->i', self._centroids, self._centroids) - 2 * self._centroids @ query
+        probes = np.argsort(centroid_distances)[:LOCAL_IVF_NPROBE]
+        candidates = np.concatenate([self._inverted[i] for i in probes])
+        return candidates if len(candidates) >= n_results else None
+
+    def _search(self, query: np.ndarray, n_results: int):
+        k = min(n_results, len(self._rows))
+        if k == 0:
+            return [], []
+        candidates = self._candidates(query, k)
+        if candidates is None:
+            vectors, norms = self._matrix, self._norms
+        else:
+            vectors, norms = self._matrix[candidates], self._norms[candidates]
+        distances = norms + float(query @ query) - 2 * self._dot(vectors, query)
+        if candidates is None:
+            distances[~self._alive] = np.inf
+
+        rescore = self._matrix is not self._full
+        n_top = min(k * LOCAL_RESCORE_FACTOR, len(self._rows), len(distances)) if rescore else k
+        top = np.argpartition(distances, n_top - 1)[:n_top]
+        if not rescore:
+            top = top[np.argsort(distances[top])]
+            rows = top if candidates is None else candidates[top]
+            return [int(row) for row in rows], [float(d) for d in distances[top]]
+
+        # Точный пересчёт небольшого набора кандидатов по float32
+        rows = np.sort(top if candidates is None else candidates[top])
+        diff = np.asarray(self._full[rows], dtype=np.float32) - query
+        exact = np.einsum('ij,ij->i', diff, diff)
+        best = np.argsort(exact)[:k]
+        return [int(row) for row in rows[best]], [float(d) for d in exact[best]]
+
+    def _exact_search(self, query: np.ndarray, n_results: int) -> list:
+        """Полный перебор по float32 без IVF и квантования"""
+        k = min(n_results, len(self._rows))
+        if k == 0:
+            return []
+        distances = np.empty(self._size, dtype=np.float32)
+        for start in range(0, self._size, _ROW_BATCH):
+            diff = np.asarray(self._full[start:start + _ROW_BATCH], dtype=np.float32) - query
+            distances[start:start + _ROW_BATCH] = np.einsum('ij,ij->i', diff, diff)
+        distances[~self._alive] = np.inf
+        return np.argpartition(distances, k - 1)[:k].tolist()
+
+    def recall(self, query_embeddings, n_results: int = 10) -> float:
+        """
+        Доля точных соседей, которые находит обычный поиск. Показывает, сколько теряют IVF и квантование
+
+        Returns:
+            float: Средний recall@n_results по запросам
+        """
+        queries = np.atleast_2d(np.asarray(query_embeddings, dtype=np.float32))
+        with self._lock:
+            self._refresh()
+            total = 0.0
+            for query in queries:
+                exact = set(self._exact_search(query, n_results))
+                if exact:
+                    total += len(exact & set(self._search(query, n_results)[0])) / len(exact)
+            return total / len(queries) if len(queries) else 0.0
+
+    def _maintain(self):
+        alive = len(self._rows)
+        dead = self._size - alive
+        if dead >= LOCAL_COMPACT_MIN_ROWS and dead > alive:
+            self._compact()
+        if self.dtype == np.int8 and self._quantizer is None and alive >= LOCAL_CALIBRATION_ROWS:
+            self.calibrate()
+        if alive >= LOCAL_IVF_MIN_ROWS and alive >= 2 * self._trained_rows:
+            self.build_index()
+
+    def calibrate(self, sample_size: int = 100000):
+        """
+        Калибровка int8: по каждой координате берутся 0.1 и 99.9 перцентили выборки живых векторов,
+        диапазон между ними делится на 256 шагов. Матрица поиска пересобирается из float32
+        """
+        with self._writing():
+            alive_rows = np.flatnonzero(self._alive)
+            rng = np.random.default_rng(0)
+            sample = np.sort(rng.choice(alive_rows, size=min(len(alive_rows), sample_size), replace=False))
+            vectors = np.asarray(self._full[sample], dtype=np.float32)
+            low = np.percentile(vectors, 0.1, axis=0)
+            high = np.percentile(vectors, 99.9, axis=0)
+            quantizer = np.stack([low, np.maximum(high - low, 1e-6) / 255]).astype(np.float32)
+
+            self._quantizer = quantizer
+            tmp_path = f"{self._vectors_path}.tmp"
+            with open(tmp_path, 'wb') as f:
+                for start in range(0, self._size, _ROW_BATCH):
+                    f.write(self._encode(np.asarray(self._full[start:start + _ROW_BATCH])).tobytes())
+            os.replace(tmp_path, self._vectors_path)
+            # quantizer.npy пишется последним: без него vectors.bin не используется
+            np.save(self._quantizer_path, quantizer)
+            self._bump_generation()
+            self._db.commit()
+            self._remap()
+            self._norms = self._row_norms(0, self._size)
+            logger.info(f"Calibrated int8 storage for {self.name} on {len(sample)} vectors")
+
+    def build_index(self):
+        """Обучает IVF центроиды на выборке живых строк и раскладывает по спискам все строки"""
+        with self._writing():
+            alive_rows = np.flatnonzero(self._alive)
+            n_lists = int(min(max(np.sqrt(len(alive_rows)), 1), 4096))
+            rng = np.random.default_rng(0)
+            sample = np.sort(rng.choice(alive_rows, size=min(len(alive_rows), n_lists * 40), replace=False))
+            centroids = _kmeans(np.asarray(self._full[sample], dtype=np.float32), n_lists)
+            lists = np.concatenate([
+                _nearest(self._full[alive_rows[start:start + 8192]], centroids)
+                for start in range(0, len(alive_rows), 8192)
+            ])
+            self._db.executemany(
+                "UPDATE rows SET list = ? WHERE row = ?", zip(lists.tolist(), alive_rows.tolist())
+            )
+            self._set_info('trained_rows', len(alive_rows))
+            self._bump_generation()
+            self._db.commit()
+            np.save(self._centroids_path, centroids)
+            self._centroids = centroids
+            self._lists[alive_rows] = lists
+            self._trained_rows = len(alive_rows)
+            self._inverted = None
+            logger.info(f"Built IVF index for {self.name}: {n_lists} lists over {len(alive_rows)} vectors")
+
+    def _compact(self, batch: int = 8192):
+        """Перезаписывает файлы векторов без удалённых строк и перенумеровывает строки. Вызывается внутри _writing"""
+        alive_rows = np.flatnonzero(self._alive)
+        files = [(self._full_path, self._full)]
+        if self._has_codes:
+            files.append((self._vectors_path, self._matrix))
+        for path, matrix in files:
+            with open(f"{path}.tmp", 'wb') as f:
+                for start in range(0, len(alive_rows), batch):
+                    f.write(np.ascontiguousarray(matrix[alive_rows[start:start + batch]]).tobytes())
+        # Строки идут по возрастанию, новый номер не больше старого, поэтому UPDATE не натыкается на занятый row
+        self._db.executemany(
+            "UPDATE rows SET row = ? WHERE row = ?", enumerate(alive_rows.tolist())
+        )
+        self._matrix = self._full = None
+        for path, _ in files:
+            os.replace(f"{path}.tmp", path)
+        self._bump_generation()
+        self._db.commit()
+        logger.info(f"Compacted {self.name}: {self._size - len(alive_rows)} deleted rows dropped")
+        self._load()
+
+    def close(self):
+        with self._lock:
+            self._matrix = self._full = None
+            self._db.close()
+
+
+class LocalVectorStore:
+    """Набор локальных коллекций в одном каталоге, интерфейс как у клиента Chroma"""
+
+    def __init__(self, directory: str = LOCAL_STORE_DIR, dtype: str = LOCAL_STORE_DTYPE):
+        self.directory = directory
+        self.dtype = dtype
+        self._collections = {}
+        self._lock = threading.Lock()
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def get_or_create_collection(self, name: str) -> LocalCollection:
+        with self._lock:
+            collection = self._collections.get(name)
+            if collection is None:
+                collection = LocalCollection(self, name, self._path(name), self.dtype)
+                self._collections[name] = collection
+            return collection
+
+    def get_collection(self, name: str) -> LocalCollection:
+        if name not in self._collections and not os.path.isdir(self._path(name)):
+            raise CollectionNotFoundError(f"Collection {name} does not exist.")
+        return self.get_or_create_collection(name)
+
+    def list_collections(self) -> list:
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(name for name in os.listdir(self.directory) if os.path.isdir(self._path(name)))
+
+    def delete_collection(self, name: str):
+        with self._lock:
+            collection = self._collections.pop(name, None)
+            if collection is not None:
+                collection.close()
+            if not os.path.isdir(self._path(name)):
+                raise CollectionNotFoundError(f"Collection {name} does not exist.")
+            shutil.rmtree(self._path(name))
+
+    def _rename(self, collection: LocalCollection, name: str):
+        with self._lock, collection._lock:
+            if os.path.exists(self._path(name)):
+                raise ValueError(f"Collection {name} already exists.")
+            collection.close()
+            os.rename(collection.directory, self._path(name))
+            self._collections.pop(collection.name, None)
+            collection.name = name
+            collection.directory = self._path(name)
+            collection._open()
+            self._collections[name] = collection